@@ -31,12 +31,12 @@ from chimera.instruments.dome import DomeBase
 from chimera.interfaces.dome import Mode
 
 from chimera.core.lock import lock
-from chimera.core.exceptions import ObjectNotFoundException
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
 
 from astelcoexceptions import AstelcoException, AstelcoDomeException
+from tplclient import TPLClient
 
-class AstelcoDome(DomeBase):
+class AstelcoDome(TPLClient, DomeBase):
     '''
     AstelcoDome interfaces chimera with TSI system to control dome.
     '''
@@ -64,6 +64,9 @@ class AstelcoDome(DomeBase):
 
         self._errorString = ""
 
+        # TPL proxies, see TPLClient
+        self._resetTPL()
+
         # debug log
         self._debugLog = None
 
@@ -82,10 +85,11 @@ class AstelcoDome(DomeBase):
 
         tpl = self.getTPL()
         # Reading position
-        self._position = tpl.getobject('POSITION.HORIZONTAL.DOME')
-        self._slitOpen = tpl.getobject('AUXILIARY.DOME.REALPOS') > 0
-        self._slitPos = tpl.getobject('AUXILIARY.DOME.REALPOS')
-        self._syncmode = tpl.getobject('POINTING.SETUP.DOME.SYNCMODE')
+        self._position, self._slitPos, self._syncmode = \
+            tpl.getresults([tpl.get_async('POSITION.HORIZONTAL.DOME'),
+                            tpl.get_async('AUXILIARY.DOME.REALPOS'),
+                            tpl.get_async('POINTING.SETUP.DOME.SYNCMODE')])
+        self._slitOpen = self._slitPos > 0
         self._tel = self.getTelescope()
 
         if self._syncmode == 0:
@@ -196,6 +200,10 @@ class AstelcoDome(DomeBase):
         :return: True
         '''
 
+        if not self._checkTPL():
+            self.log.error('[control] Could not reach TPL.')
+            return True
+
         tpl = self.getTPL()
         self.log.debug('[control] %s' % tpl.getobject('SERVER.UPTIME'))
 
@@ -205,7 +213,11 @@ class AstelcoDome(DomeBase):
     def isSlewing(self):
 
         tpl = self.getTPL()
-        motionState = tpl.getobject('TELESCOPE.MOTION_STATE')
+        motionState = tpl.getsubscribed('TELESCOPE.MOTION_STATE')
+        if motionState is None:
+            # could not be read, assume nothing changed
+            self.log.warning('Could not read TELESCOPE.MOTION_STATE.')
+            return self._slewing
         return ( motionState != 11 )
 
     def abortSlew(self):
@@ -370,16 +382,6 @@ class AstelcoDome(DomeBase):
         return self._slitOpen
 
     # utilitaries
-    def getTPL(self):
-        try:
-            p = self.getManager().getProxy(self['tpl'], lazy=True)
-            if not p.ping():
-                return False
-            else:
-                return p
-        except ObjectNotFoundException:
-            return False
-
     def getMetadata(self, request):
         baseHDR = super(DomeBase, self).getMetadata(request)
         newHDR = [("DOME_AZ",self.getAz().toDMS().__str__(),"Dome Azimuth"),
@@ -388,4 +390,4 @@ class AstelcoDome(DomeBase):
         for new in newHDR:
             baseHDR.append(new)
 
-        return baseHDR
\ No newline at end of file
+        return baseHDR
@@ -29,12 +29,12 @@ from chimera.interfaces.focuser import (InvalidFocusPositionException,
 from chimera.instruments.focuser import FocuserBase
 
 from chimera.core.lock import lock
-from chimera.core.exceptions import ObjectNotFoundException
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
 
 from chimera.util.enum import Enum
 
 from astelcoexceptions import AstelcoException, AstelcoHexapodException
+from tplclient import TPLClient
 
 Direction = Enum("IN", "OUT")
 Axis = FocuserAxis #Enum("X", "Y", "Z", "U", "V")  # For hexapod
@@ -54,7 +54,7 @@ AxisUnit = {Axis.X : 'unit_x',
             }
 FocusPosition = collections.namedtuple('Focus','X Y Z U V')
 
-class AstelcoFocuser(FocuserBase):
+class AstelcoFocuser(TPLClient, FocuserBase):
     '''
 AstelcoFocuser interfaces chimera with TSI system to control focus. System 
 can be equiped with hexapod hardware. In this case, comunication is done in a
@@ -108,6 +108,9 @@ vector. Temperature compensation can also be performed.
         self._errorNo = 0
         self._errorString = ""
 
+        # TPL proxies, see TPLClient
+        self._resetTPL()
+
         # debug log
         self._debugLog = None
         try:
@@ -131,11 +134,17 @@ vector. Temperature compensation can also be performed.
                 self._rangeControllableAxis[i] = [None, None]
                 self._step[ControllableAxis[i]] = float(self[AxisStep[ControllableAxis[i]]])
 
+            # Fire all requests at once and collect them after
+            cmdids = []
             for ax in Axis:
-                min_ = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS!MIN' % ax.index)
-                max_ = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS!MAX' % ax.index)
-                self._position[ax] = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS' % ax.index)
-                self._offset[ax] = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].OFFSET' % ax.index)
+                cmdids.append([tpl.get_async('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS!MIN' % ax.index),
+                               tpl.get_async('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS!MAX' % ax.index),
+                               tpl.get_async('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS' % ax.index),
+                               tpl.get_async('POSITION.INSTRUMENTAL.FOCUS[%i].OFFSET' % ax.index)])
+            results = tpl.getresults([cmdid for axcmds in cmdids for cmdid in axcmds])
+
+            for i, ax in enumerate(Axis):
+                min_, max_, self._position[ax], self._offset[ax] = results[4 * i:4 * i + 4]
 
                 try:
                     min_ = float(min_)
@@ -170,6 +179,10 @@ vector. Temperature compensation can also be performed.
         :return: True
         '''
 
+        if not self._checkTPL():
+            self.log.error('[control] Could not reach TPL.')
+            return True
+
         self.updatePosition()
         self.updateTemperature()
 
@@ -253,9 +266,16 @@ vector. Temperature compensation can also be performed.
     @lock
     def updatePosition(self):
         tpl = self.getTPL()
+        objects = []
+        for ax in Axis:
+            objects.append('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS' % ax.index)
+            objects.append('POSITION.INSTRUMENTAL.FOCUS[%i].OFFSET' % ax.index)
+
+        values = tpl.getobjects(objects)
+
         for ax in Axis:
-            self._position[ax] = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS' % ax.index)
-            self._offset[ax] = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].OFFSET' % ax.index)
+            self._position[ax] = values['POSITION.INSTRUMENTAL.FOCUS[%i].REALPOS' % ax.index]
+            self._offset[ax] = values['POSITION.INSTRUMENTAL.FOCUS[%i].OFFSET' % ax.index]
 
     @lock
     def updateTemperature(self):
@@ -281,7 +301,8 @@ vector. Temperature compensation can also be performed.
             self.log.error(msg)
             raise InvalidFocusPositionException(msg)
 
-        MSTATE = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].MOTION_STATE' % axis.index)
+        mobject = 'POSITION.INSTRUMENTAL.FOCUS[%i].MOTION_STATE' % axis.index
+        MSTATE = tpl.subscribe([mobject])[mobject]
         mbitcode = [0, 1, 2, 3, 4]
         MMESSG = ['Axis is moving',
                   'Trajectory is running',
@@ -291,27 +312,34 @@ vector. Temperature compensation can also be performed.
         moving = True
         self._abort.clear()
         cmd = tpl.getCmd(cmdid)
-        while moving:
-            if cmd.complete:
-                moving = False
-                break
-            MSTATE = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].MOTION_STATE' % axis.index)
-            moving = MSTATE != 0
-            state = moving
-            msg = ''
-            for ib, bit in enumerate(mbitcode):
-                if ( MSTATE & (1 << bit) ) != 0:
-                    #STATE = False
-                    msg += MMESSG[ib] + '|'
-            if len(msg) > 0:
-                self.log.info(msg)
-            if time.time() > start+self["move_timeout"]:
-                raise AstelcoHexapodException("Operation timed out.")
-            if self._abort.isSet():
-                self.log.info('Operation aborted')
-                # Todo: abort operation
-                break
-            cmd = tpl.getCmd(cmdid)
+        try:
+            while moving:
+                if cmd.complete:
+                    moving = False
+                    break
+                MSTATE = tpl.waitchange(mobject, MSTATE, self["updatetime"])
+                if MSTATE is None:
+                    # could not be read, keep waiting for the command
+                    self.log.warning('Could not read %s.' % mobject)
+                else:
+                    moving = MSTATE != 0
+                    state = moving
+                    msg = ''
+                    for ib, bit in enumerate(mbitcode):
+                        if ( MSTATE & (1 << bit) ) != 0:
+                            #STATE = False
+                            msg += MMESSG[ib] + '|'
+                    if len(msg) > 0:
+                        self.log.info(msg)
+                if time.time() > start+self["move_timeout"]:
+                    raise AstelcoHexapodException("Operation timed out.")
+                if self._abort.isSet():
+                    self.log.info('Operation aborted')
+                    tpl.abort(cmdid)
+                    break
+                cmd = tpl.getCmd(cmdid)
+        finally:
+            tpl.unsubscribe([mobject])
         # check limit state
         LSTATE = tpl.getobject('POSITION.INSTRUMENTAL.FOCUS[%i].LIMIT_STATE' % axis.index)
         #code = '%16s'%(bin(LSTATE)[2:][::-1])
@@ -348,13 +376,3 @@ vector. Temperature compensation can also be performed.
             self.log.warning('Minimum and maximum positions not defined...')
             return True
         return min_pos <= n <= max_pos
-
-    def getTPL(self):
-        try:
-            p = self.getManager().getProxy(self['tpl'], lazy=True)
-            if not p.ping():
-                return False
-            else:
-                return p
-        except ObjectNotFoundException:
-            return False
@@ -45,6 +45,7 @@ from chimera.core.exceptions import ObjectNotFoundException, ObjectTooLowExcepti
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
 
 from astelcoexceptions import AstelcoException, AstelcoTelescopeException
+from tplclient import TPLClient
 
 Direction = Enum("E", "W", "N", "S")
 AstelcoTelescopeStatus = Enum("NoLICENSE",
@@ -55,16 +56,174 @@ AstelcoTelescopeStatus = Enum("NoLICENSE",
                               "WARNING",
                               "INFO")
 
-class AstelcoTelescope(TelescopeBase):  # converted to Astelco
+
+class TelescopeState(object):
+    '''
+    Snapshot of the telescope state, read from TPL with a single batched
+    request. Values are as TPL gives them (RA and LST in hours, angles in
+    degrees), None if they could not be read. time is when they were read.
+    '''
+
+    # field, TPL object
+    Objects = [('ra', 'POSITION.EQUATORIAL.RA_J2000'),
+               ('dec', 'POSITION.EQUATORIAL.DEC_J2000'),
+               ('alt', 'POSITION.HORIZONTAL.ALT'),
+               ('az', 'POSITION.HORIZONTAL.AZ'),
+               ('lst', 'POSITION.LOCAL.SIDEREAL_TIME'),
+               ('ha_offset', 'POSITION.INSTRUMENTAL.HA.OFFSET'),
+               ('dec_offset', 'POSITION.INSTRUMENTAL.DEC.OFFSET'),
+               ('motion_state', 'TELESCOPE.MOTION_STATE'),
+               ('ha_motion_state', 'POSITION.INSTRUMENTAL.HA.MOTION_STATE'),
+               ('dec_motion_state', 'POSITION.INSTRUMENTAL.DEC.MOTION_STATE'),
+               ('track', 'POINTING.TRACK'),
+               ('ready_state', 'TELESCOPE.READY_STATE'),
+               ('status', 'TELESCOPE.STATUS.GLOBAL')]
+
+    __slots__ = ['ra', 'dec', 'alt', 'az', 'lst', 'ha_offset', 'dec_offset',
+                 'motion_state', 'ha_motion_state', 'dec_motion_state', 'track',
+                 'ready_state', 'status', 'time']
+
+    def __init__(self, values, t):
+        for name, object in self.Objects:
+            setattr(self, name, values.get(object))
+        self.time = t
+
+    @classmethod
+    def read(cls, tpl):
+        t = time.time()
+        return cls(tpl.getobjects([object for name, object in cls.Objects]), t)
+
+    def age(self):
+        return time.time() - self.time
+
+    def __getstate__(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __str__(self):
+        return ' '.join(['%s=%s' % (name, getattr(self, name)) for name in self.__slots__])
+
+
+class SensorSnapshot(tuple):
+    '''
+    Sensor readings as (description, value, unit) header cards. version
+    grows with every read, so callers can tell whether anything changed,
+    and time is when the values were read.
+    '''
+
+    def __new__(cls, cards, version, t):
+        self = tuple.__new__(cls, cards)
+        self.version = version
+        self.time = t
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self), self.version, self.time
+
+
+class SensorHistory(object):
+    '''
+    Last 'capacity' readings of a sensor, in a fixed size ring buffer.
+    Readings that could not be read or converted to float are kept as NaN
+    and left out of the statistics.
+    '''
+
+    def __init__(self, capacity):
+        self._times = np.zeros(capacity)
+        self._values = np.zeros(capacity)
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, t, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = np.nan
+
+        self._lock.acquire()
+        try:
+            self._times[self._next] = t
+            self._values[self._next] = value
+            self._next = (self._next + 1) % len(self._times)
+            self._count = min(self._count + 1, len(self._times))
+        finally:
+            self._lock.release()
+
+    def samples(self, start=None, end=None):
+        '''
+        :return: (times, values) arrays of the readings between start and
+                 end (inclusive, seconds since the epoch), oldest first.
+        '''
+
+        self._lock.acquire()
+        try:
+            order = np.arange(self._next - self._count, self._next) % len(self._times)
+            times = self._times[order]
+            values = self._values[order]
+        finally:
+            self._lock.release()
+
+        mask = np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask &= times >= start
+        if end is not None:
+            mask &= times <= end
+
+        return times[mask], values[mask]
+
+    def downsample(self, step, start=None, end=None):
+        '''
+        Statistics of the readings between start and end in windows of
+        step seconds. Windows without valid readings are left out.
+
+        :return: list of (window start, min, max, mean, number of readings).
+        '''
+
+        if not step > 0:
+            raise ValueError("Window step must be positive, got %s." % step)
+
+        times, values = self.samples(start, end)
+
+        valid = ~np.isnan(values)
+        times, values = times[valid], values[valid]
+        if not len(times):
+            return []
+
+        if start is None:
+            start = times[0]
+
+        windows = np.floor((times - start) / step).astype(int)
+        first = np.concatenate(([0], np.flatnonzero(np.diff(windows)) + 1))
+        counts = np.diff(np.concatenate((first, [len(values)])))
+
+        mins = np.minimum.reduceat(values, first)
+        maxs = np.maximum.reduceat(values, first)
+        means = np.add.reduceat(values, first) / counts
+
+        return [(float(start + windows[i] * step), float(mins[j]), float(maxs[j]), float(means[j]),
+                 int(counts[j])) for j, i in enumerate(first)]
+
+
+class AstelcoTelescope(TPLClient, TelescopeBase):  # converted to Astelco
 
     __config__ = {'azimuth180Correct': False,
                   'maxidletime': 90.,
                   'parktimeout': 600.,
                   'sensors': 7,
+                  'sensors_interval': 30.,  # time (s) between reads of the sensor values
+                  'sensors_labels_interval': 3600.,  # time (s) between reads of the sensor descriptions
+                  'sensors_history': 2880,  # readings kept per sensor, see getSensorHistory
                   'pointing_model': None,      # The filename of the pointing model. None is leave as is
                   'pointing_model_type': None, # Type of pointing model. None is leave as is. either 0,1 or 2
                   'pointing_setup_orientation': None,
                   'pointing_setup_optimization': None,
+                  'state_max_age': 1.,  # telescope state snapshots younger than this (s) are reused
+                  'read_timeout': 10.,  # deadline (s) of reads that can not do without an answer
+                  'slew_max_poll': 2.,  # longest wait (s) between checks of a slew, see _slewPollInterval
                   'tpl':'/TPL/0'}  # TODO: FIX tpl so I can get COUNT on an axis.
 
 
@@ -90,6 +249,13 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         self._az = None
         self._alt = None
 
+        # last TelescopeState, see getState
+        self._state = None
+        self._statelock = threading.Lock()
+
+        # TPL proxies, see TPLClient
+        self._resetTPL()
+
         # debug log
         self._debugLog = None
         try:
@@ -105,7 +271,18 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         self._calibrationFile = os.path.join(
             SYSTEM_CONFIG_DIRECTORY, "move_calibration.bin")
 
-        self.sensors = []
+        # Last sensor readings and the poller thread updating them. Sensor
+        # descriptions and units seldom change, so they are kept in
+        # _sensorlabels as (number, description, unit) and only read again
+        # every 'sensors_labels_interval', or as soon as a read fails.
+        self._sensors = SensorSnapshot([], 0, 0.)
+        self._sensorlabels = None
+        self._sensorlabelstime = 0.
+        self._sensorlabelsstale = False
+        self._sensorhistory = {}
+        self._sensorlock = threading.Lock()
+        self._sensorpoller = None
+        self._sensorpoller_stop = threading.Event()
 
         for rate in SlewRate:
             self._calibration[rate] = {}
@@ -120,6 +297,12 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
         self.open()
 
+        self._sensorpoller_stop.clear()
+        self._sensorpoller = threading.Thread(target=self._sensorloop,
+                                              name='astelco-sensors')
+        self._sensorpoller.setDaemon(True)
+        self._sensorpoller.start()
+
         # try to read saved calibration data
         if os.path.exists(self._calibrationFile):
             try:
@@ -137,6 +320,10 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         # if self.isSlewing():
         #     self.abortSlew()
 
+        self._sensorpoller_stop.set()
+        if self._sensorpoller is not None:
+            self._sensorpoller.join(self['maxidletime'])
+
         return True
 
     @lock
@@ -152,8 +339,6 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
             else:
                 self._initTelescope()
 
-            # Update sensors and position
-            self.updateSensors()
             tpl = self.getTPL()
             tpl.set('AUXILIARY.PADDLE.BRIGHTNESS',0.0) # set brightness to zero
             # Loading pointing model
@@ -182,9 +367,9 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
                         if cmd.complete:
                             modelinfo = tpl.getobject('POINTING.MODEL.CALCULATE')
                             self.log.info('Pointing model quality: %s'%modelinfo)
-            ptm_type = tpl.getobject('POINTING.MODEL.TYPE')
-            pt_model = tpl.getobject('POINTING.MODEL.FILE')
-            modelinfo = tpl.getobject('POINTING.MODEL.CALCULATE')
+            ptm_type, pt_model, modelinfo = tpl.getresults([tpl.get_async('POINTING.MODEL.TYPE'),
+                                                            tpl.get_async('POINTING.MODEL.FILE'),
+                                                            tpl.get_async('POINTING.MODEL.CALCULATE')])
             mtype = 'None' if ptm_type == 0 else 'NORMAL' if ptm_type == 1 else "EXTENDED"
             self.log.debug('Pointing model info:\n\tNAME: %s\n\tTYPE: %s\n\tQUALITY: %s.'%(pt_model,mtype,modelinfo))
 
@@ -199,8 +384,8 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
             if self['pointing_setup_optimization'] is not None:
                 tpl.set('POINTING.SETUP.OPTIMIZATION',self['pointing_setup_optimization'])
 
-            orient = tpl.getobject('POINTING.SETUP.ORIENTATION')
-            optim = tpl.getobject('POINTING.SETUP.OPTIMIZATION')
+            orient, optim = tpl.getresults([tpl.get_async('POINTING.SETUP.ORIENTATION'),
+                                            tpl.get_async('POINTING.SETUP.OPTIMIZATION')])
 
             orient = 'NORMAL' if orient == 0 else 'REVERSE' if orient == 1 else 'AUTOMATIC'
             optim = 'NO OPTIMIZATION' if optim == 0 else 'MAX TRACKING TIME' if optim == 1 else "MIN SLEW TIME"
@@ -230,6 +415,10 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
         #self.log.debug('[control] %s'%self._tpl.getobject('SERVER.UPTIME'))
 
+        if not self._checkTPL():
+            self.log.error('[control] Could not reach TPL.')
+            return True
+
         status = self.getTelescopeStatus()
 
         if status == AstelcoTelescopeStatus.OK:
@@ -248,9 +437,6 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
             self.log.error('[control] Telescope in %s mode!' % status)
             # return False
 
-        # Update sensor and coordinate information
-        self.updateSensors()
-
         # self.getRa()
         # self.getDec()
         # self.getAlt()
@@ -290,15 +476,31 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
                              " attitude cannot be determined.")
 
     # utilitaries
-    def getTPL(self):
+    def getState(self, max_age=None):
+        '''
+        Get a snapshot of the telescope state. The last one is reused while
+        it is younger than max_age (s), 'state_max_age' by default, so that
+        callers asking for position and motion at about the same time share
+        a single TPL request.
+
+        :return: TelescopeState
+        '''
+
+        if max_age is None:
+            max_age = self['state_max_age']
+
+        self._statelock.acquire()
         try:
-            p = self.getManager().getProxy(self['tpl'], lazy=True)
-            if not p.ping():
-                return False
-            else:
-                return p
-        except ObjectNotFoundException:
-            return False
+            state = self._state
+            if state is None or state.age() > max_age:
+                state = self._state = TelescopeState.read(self.getTPL())
+            return state
+        finally:
+            self._statelock.release()
+
+    def _invalidateState(self):
+        # the telescope was just told to move, do not trust the last snapshot
+        self._state = None
 
     def getPMFile(self):
         '''
@@ -441,7 +643,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
         tpl = self.getTPL()
 
-        ret = tpl.getobject('TELESCOPE.CONFIG.MOUNTOPTIONS')
+        ret = tpl.getobject('TELESCOPE.CONFIG.MOUNTOPTIONS', timeout=self['read_timeout'])
 
         if not ret or ret not in ("AZ-ZD", "ZD-ZD", "HA-DEC"):
             raise AstelcoException(
@@ -504,8 +706,9 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
         tpl = self.getTPL()
         # slew
-        slewTime = tpl.getobject('POINTING.SLEWTIME')
-        self.log.info("Time to slew to RA/Dec is reported to be %f s" % ( slewTime ))
+        slewTime = tpl.getobject('POINTING.SLEWTIME', timeout=self['read_timeout'])
+        # None if it could not be read, _waitSlew then falls back to max_slew_time
+        self.log.info("Time to slew to RA/Dec is reported to be %s s" % ( slewTime ))
 
         target = self.getTargetRaDec()
 
@@ -547,7 +750,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         self._abort.clear()
 
         tpl = self.getTPL()
-        slewTime = tpl.getobject('POINTING.SLEWTIME')
+        slewTime = tpl.getobject('POINTING.SLEWTIME', timeout=self['read_timeout'])
 
         self.log.debug("Time to slew to Alt/Az is reported to be %s s." % slewTime)
 
@@ -555,99 +758,45 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         self.log.debug("Target Alt/Az  %s s." % target)
 
         # return TelescopeStatus.OK
-        return self._waitSlew(time.time(), target, local=True)
+        return self._waitSlew(time.time(), target, local=True, slew_time=slewTime)
 
     def _waitSlew(self, start_time, target, local=False, slew_time=-1):  # converted to Astelco
         self.slewBegin(target)
         # todo: raise an exception if telescope is parked
         tpl = self.getTPL()
+
+        if slew_time is None or slew_time <= 0:
+            slew_time = tpl.getobject('POINTING.SLEWTIME') or self['max_slew_time']
+
         # Set offset to zero
-        if abs(self._getOffset(Direction.N)) > 0:
+        state = self.getState(0)
+        if state.dec_offset:
             cmdid = tpl.set('POSITION.INSTRUMENTAL.DEC.OFFSET', 0.0, wait=True)
             # time.sleep(self["stabilization_time"])
-        if abs(self._getOffset(Direction.W)) > 0:
+        if state.ha_offset:
             cmdid = tpl.set('POSITION.INSTRUMENTAL.HA.OFFSET', 0.0, wait=True)
             # time.sleep(self["stabilization_time"])
 
         self.log.debug('SEND: POINTING.TRACK 2')
         cmdid = tpl.set('POINTING.TRACK', 2, wait=False)
+        self._invalidateState()
         self.log.debug('PASSED')
 
-        cmd = tpl.getCmd(cmdid)
-
-        # time_sent = time.time()
-        while not cmd.complete:
-
-            if not self.checkLimits():
-                return TelescopeStatus.ABORTED
-
-            if self._abort.isSet():
-                self._slewing = False
-                self.stopMoveAll()
-                self.slewComplete(self.getPositionRaDec(),
-                    TelescopeStatus.ABORTED)
-                return TelescopeStatus.ABORTED
-
-            # check timeout
-            if time.time() >= (start_time + self["max_slew_time"]):
-                self.stopMoveAll()
-                self._slewing = False
-                self.log.error('Slew aborted. Max slew time reached.')
-                raise AstelcoException("Slew aborted. Max slew time reached.")
-
-            if time.time() >= (start_time + slew_time):
-                self.log.warning('Estimated slewtime has passed...')
-                position = self.getPositionRaDec()
-                if local:
-                    position = self.getPositionAltAz()
-                angsep = target.angsep(position)
-                self.log.debug('Target: %s | Position: %s | Distance: %s' % (target, position, angsep))
-
-                slew_time += slew_time
-
-            # time.sleep(self["slew_idle_time"])
-            cmd = tpl.getCmd(cmdid)
-
-        #     time.sleep(self["slew_idle_time"])
-        #     if time.time() > time_sent+self["max_slew_time"]:
-        #         break
-        #
-        # err = not cmd.ok
-        #
-        # if err:
-        #     # check error message
-        #     msg = cmd.received
-        #     self.log.error('Error pointing to %s' % target)
-        #     for line in msg:
-        #         self.log.error(line)
-        #     self.slewComplete(self.getPositionRaDec(),
-        #         TelescopeStatus.ERROR)
-        #
-        #     return TelescopeStatus.ERROR
-
-        # self.log.debug('Wait cmd complete...')
-        # status = self.waitCmd(cmdid, start_time, slew_time)
-        # self.log.debug('Done')
-
-        # if status != TelescopeStatus.OK:
-        #     self.log.warning('Pointing operations failed with status: %s...' % status)
-        #     self.slewComplete(self.getPositionRaDec(),
-        #         status)
-        #     return status
-
-        # self.log.debug('Wait movement start...')
-        # time.sleep(self["stabilization_time"])
-
-        self.log.debug('Wait slew to complete...')
+        # First wait for the pointing command to complete, then for the
+        # motion to stop. Every tick reads the whole state in one request,
+        # which checkLimits and the position checks below share.
+        pointing = True
 
         while True:
 
+            state = self.getState(0)
+
             if not self.checkLimits():
                 return TelescopeStatus.ABORTED
 
             if self._abort.isSet():
                 self._slewing = False
-                self.abortSlew()
+                self._stopSlew()
                 self.slewComplete(self.getPositionRaDec(),
                     TelescopeStatus.ABORTED)
                 return TelescopeStatus.ABORTED
@@ -666,29 +815,42 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
                     position = self.getPositionAltAz()
                 angsep = target.angsep(position)
                 self.log.debug('Target: %s | Position: %s | Distance: %f' % (target, position, angsep.AS))
-                if angsep.AS < 60.:
-                    self.abortSlew()
+                if not pointing and angsep.AS < 60.:
+                    self._stopSlew()
 
                 slew_time += slew_time
 
-            dec_state = tpl.getobject('POSITION.INSTRUMENTAL.DEC.MOTION_STATE')
-            ha_state = tpl.getobject('POSITION.INSTRUMENTAL.DEC.MOTION_STATE')
-
-            mstate = tpl.getobject('TELESCOPE.MOTION_STATE')
-
-            self.log.debug('MSTATE: %i (%s) dec= %s ra=%s' % (mstate, bin(mstate),bin(dec_state),bin(ha_state)))
-            if (mstate & 1) == 0:
-                self.log.debug('Slew finished...')
-                return TelescopeStatus.OK
-
-            # time.sleep(self["slew_idle_time"])
-            cmd = tpl.getCmd(cmdid)
+            if pointing:
+                if tpl.getCmd(cmdid).complete:
+                    self.log.debug('Wait slew to complete...')
+                    pointing = False
+                    continue
+            elif state.motion_state is not None:
+                self.log.debug('MSTATE: %i (%s) dec= %s ha=%s' % (state.motion_state, bin(state.motion_state),
+                                                                  bin(state.dec_motion_state or 0),
+                                                                  bin(state.ha_motion_state or 0)))
+                if (state.motion_state & 1) == 0:
+                    self.log.debug('Slew finished...')
+                    return TelescopeStatus.OK
+
+            self._abort.wait(self._slewPollInterval(start_time, slew_time))
+
+    def _slewPollInterval(self, start_time, slew_time):
+        '''
+        Time (s) to wait before checking a slew again: a quarter of the time
+        left to the estimated arrival, no less than 'slew_idle_time' and no
+        more than 'slew_max_poll'. Polls are sparse early in long slews and
+        frequent close to arrival.
+        '''
+        remaining = start_time + slew_time - time.time()
+        return min(max(remaining / 4., self['slew_idle_time']), self['slew_max_poll'])
 
     def _startTracking(self, start_time, target, local=False, slew_time=-1):  # converted to Astelco):
 
         tpl = self.getTPL()
         self.log.debug('SEND: POINTING.TRACK 1')
         cmdid = tpl.set('POINTING.TRACK', 1, wait=True)
+        self._invalidateState()
         self.log.debug('PASSED')
 
         cmd = tpl.getCmd(cmdid)
@@ -711,14 +873,14 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
             if self._abort.isSet():
                 self._slewing = False
-                self.abortSlew()
+                self._stopSlew()
                 self.slewComplete(self.getPositionRaDec(),
                     TelescopeStatus.ABORTED)
                 return TelescopeStatus.ABORTED
 
             # check timeout
             if time.time() >= (start_time + self["max_slew_time"]):
-                self.abortSlew()
+                self._stopSlew()
                 self._slewing = False
                 self.log.error('Slew aborted. Max slew time reached.')
                 raise AstelcoException("Slew aborted. Max slew time reached.")
@@ -768,6 +930,11 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
     #     return TelescopeStatus.OK
 
     def abortSlew(self):  # converted to Astelco
+        # wakes up the slew wait loops at once
+        self._abort.set()
+        self._stopSlew()
+
+    def _stopSlew(self):
         self.stopMoveAll()
 
 
@@ -784,14 +951,14 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
     def _isSlewing(self):
 
-        tpl = self.getTPL()
-        self.log.debug('GET TELESCOPE.MOTION_STATE')
-        mstate = tpl.getobject('TELESCOPE.MOTION_STATE')
-        self.log.debug('GET POINTING.TRACK')
-        ptrack = tpl.getobject('POINTING.TRACK')
-        self.log.debug('Done')
+        state = self.getState()
 
-        self._slewing = (int(mstate) != 0) and (int(ptrack) != 1)
+        if state.motion_state is None or state.track is None:
+            # could not be read, assume nothing changed
+            self.log.warning('Could not read the telescope motion state.')
+            return self._slewing
+
+        self._slewing = (int(state.motion_state) != 0) and (int(state.track) != 1)
 
         return self._slewing
 
@@ -833,6 +1000,8 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
             self._slewing = False
             return True
 
+        self._invalidateState()
+
         # self.log.debug('Wait for telescope to stabilize...')
         # time.sleep(self["stabilization_time"])
         #
@@ -876,14 +1045,14 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
             if self._abort.isSet():
                 self._slewing = False
-                self.abortSlew()
+                self._stopSlew()
                 self.slewComplete(self.getPositionRaDec(),
                     TelescopeStatus.ABORTED)
                 return TelescopeStatus.ABORTED
 
             # check timeout
             if time.time() >= (start_time + self["max_slew_time"]):
-                self.abortSlew()
+                self._stopSlew()
                 self._slewing = False
                 self.log.error('Slew aborted. Max slew time reached.')
                 raise AstelcoException("Slew aborted. Max slew time reached.")
@@ -1000,6 +1169,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
     def stopMoveAll(self):  # converted to Astelco
         tpl = self.getTPL()
         tpl.set('TELESCOPE.STOP', 1, wait=True)
+        self._invalidateState()
         return True
 
     @lock
@@ -1018,8 +1188,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
     @lock
     def getRa(self):  # converted to Astelco
 
-        tpl = self.getTPL()
-        ret = tpl.getobject('POSITION.EQUATORIAL.RA_J2000')
+        ret = self.getState().ra
         if ret:
             self._ra = Coord.fromH(ret)
         self.log.debug('Ra: %s' % ret)
@@ -1027,8 +1196,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
     @lock
     def getDec(self):  # converted to Astelco
-        tpl = self.getTPL()
-        ret = tpl.getobject('POSITION.EQUATORIAL.DEC_J2000')
+        ret = self.getState().dec
         if ret:
             self._dec = Coord.fromD(ret)
         self.log.debug('Dec: %s' % ret)
@@ -1150,8 +1318,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
     @lock
     def getAz(self):  # converted to Astelco
-        tpl = self.getTPL()
-        ret = tpl.getobject('POSITION.HORIZONTAL.AZ')
+        ret = self.getState().az
         if ret:
             self._az = Coord.fromD(ret)
         self.log.debug('Az: %s' % ret)
@@ -1168,8 +1335,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
     @lock
     def getAlt(self):  # converted to Astelco
-        tpl = self.getTPL()
-        ret = tpl.getobject('POSITION.HORIZONTAL.ALT')
+        ret = self.getState().alt
         if ret:
             self._alt = Coord.fromD(ret)
         self.log.debug('Alt: %s' % ret)
@@ -1317,8 +1483,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
     @lock
     def getLocalSiderealTime(self):  # converted to Astelco
-        tpl = self.getTPL()
-        ret = tpl.getobject('POSITION.LOCAL.SIDEREAL_TIME')
+        ret = self.getState().lst
         return Coord.fromH(ret)
 
     @lock
@@ -1361,6 +1526,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
     def startTracking(self):  # converted to Astelco
         tpl = self.getTPL()
         cmdid = tpl.set('POINTING.TRACK', 1, wait=True)
+        self._invalidateState()
         return tpl.succeeded(cmdid)
 
 
@@ -1368,12 +1534,12 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
     def stopTracking(self):  # converted to Astelco
         tpl = self.getTPL()
         cmdid = tpl.set('POINTING.TRACK', 0, wait=True)
+        self._invalidateState()
         return tpl.succeeded(cmdid)
 
 
     def isTracking(self):  # converted to Astelco
-        tpl = self.getTPL()
-        return tpl.getobject('POINTING.TRACK')
+        return self.getState().track
 
 
     # -- ITelescopeSync implementation --
@@ -1410,7 +1576,7 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
 
     def isParked(self):  # (yes) -no- need to convert to Astelco
         tpl = self.getTPL()
-        self._parked = tpl.getobject('TELESCOPE.READY_STATE') == 0
+        self._parked = tpl.getsubscribed('TELESCOPE.READY_STATE') == 0
         return self._parked
 
     def isOpen(self):  # (yes) -no- need to convert to Astelco
@@ -1431,33 +1597,38 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         #                                            site["latitude"]))
         tpl = self.getTPL()
         cmdid = tpl.set('TELESCOPE.READY', 0, wait=False)
+        self._invalidateState()
 
-        ready_state = tpl.getobject('TELESCOPE.READY_STATE')
+        ready_state = tpl.subscribe(['TELESCOPE.READY_STATE'])['TELESCOPE.READY_STATE']
         start_time = time.time()
         self._abort.clear()
 
-        while ready_state > 0.0:
-            self.log.debug("Powering down Astelco: %s" % (ready_state))
-            old_ready_state = ready_state
-            ready_state = tpl.getobject('TELESCOPE.READY_STATE')
-            if ready_state != old_ready_state:
+        # followed only while waiting for it
+        try:
+            # None if it could not be read, keep waiting
+            while ready_state is None or ready_state > 0.0:
                 self.log.debug("Powering down Astelco: %s" % (ready_state))
                 old_ready_state = ready_state
-            if self._abort.set():
-                # Send abork command to astelco
-                self.log.warning("Abort parking! This will leave the telescope in an intermediate state!")
-                tpl.set('ABORT', cmdid)
-                return False
-            if time.time() > start_time + self['parktimeout']:
-                self.log.error("Parking operation timedout!")
-                return False
-            if self.getTelescopeStatus() != AstelcoTelescopeStatus.OK:
-                self.log.warning("Something wrong with telescope! Trying to fix it!")
-                self.logStatus()
-                self.acknowledgeEvents()
-                # What should I do if acknowledging events does not fix it?
-
-            time.sleep(5.0)
+                # wakes up as soon as the state changes
+                ready_state = tpl.waitchange('TELESCOPE.READY_STATE', ready_state, 5.0)
+                if ready_state != old_ready_state:
+                    self.log.debug("Powering down Astelco: %s" % (ready_state))
+                    old_ready_state = ready_state
+                if self._abort.set():
+                    # Send abork command to astelco
+                    self.log.warning("Abort parking! This will leave the telescope in an intermediate state!")
+                    tpl.set('ABORT', cmdid)
+                    return False
+                if time.time() > start_time + self['parktimeout']:
+                    self.log.error("Parking operation timedout!")
+                    return False
+                if self.getTelescopeStatus() != AstelcoTelescopeStatus.OK:
+                    self.log.warning("Something wrong with telescope! Trying to fix it!")
+                    self.logStatus()
+                    self.acknowledgeEvents()
+                    # What should I do if acknowledging events does not fix it?
+        finally:
+            tpl.unsubscribe(['TELESCOPE.READY_STATE'])
 
         # 2. stop tracking
         #self.stopTracking ()
@@ -1478,18 +1649,16 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         Bit 0 - PANIC, a severe condition, completely disabling the entire telescope,
         Bit 1 - ERROR, a serious condition, disabling important parts of the telescope system,
         Bit 2 - WARNING, a critical condition, which is not (yet) dis- abling the telescope,
-        Bit 3 - INFO, a informal situation, which is not a ecting the operation.
+        Bit 3 - INFO, a informal situation, which is not affecting the operation.
 
         :return: AstelcoTelescopeStatus{Enum}
         '''
-        status = None
-
-        tpl = self.getTPL()
+        status = self.getState().status
 
         while not status:
-            status = tpl.getobject('TELESCOPE.STATUS.GLOBAL')
             if status == 0:
                 return AstelcoTelescopeStatus.OK
+            status = self.getState(0).status
 
         if status == -2:
             return AstelcoTelescopeStatus.NoLICENSE
@@ -1529,11 +1698,15 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         # Get GLOBAL STATUS
         tpl = self.getTPL()
 
-        status = tpl.getobject('TELESCOPE.STATUS.GLOBAL')
-        if status > 0:
+        status = tpl.getobject('TELESCOPE.STATUS.GLOBAL', timeout=self['read_timeout'])
+        if status is None:
+            self.log.warning('Could not read telescope status, nothing acknowledged...')
+            return False
+        elif status > 0:
             self.log.debug("Telescope status not OK... Trying to acknowledge...")
             # writing GLOBAL status to CLEAR is how you acknowledge
             cmdid = tpl.set('TELESCOPE.STATUS.CLEAR', status)
+            self._invalidateState()
             # if clear gets new value, acknowledge may have worked
             # self.waitCmd(cmdid, time.time(), self["maxidletime"])
             # clear = self._tpl.getobject('TELESCOPE.STATUS.CLEAR')
@@ -1576,51 +1749,55 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
             return False
 
         cmdid = tpl.set('TELESCOPE.READY', 1, wait=False)
+        self._invalidateState()
 
         # 2. start tracking
         #self.startTracking()
         ready_state = 0.0
+        tpl.subscribe(['TELESCOPE.READY_STATE'])
         start_time = time.time()
         self._abort.clear()
 
-        while ready_state < 1.0:
-            self.log.debug("Powering up Astelco: %s" % (ready_state))
-            old_ready_state = ready_state
-            ready_state = tpl.getobject('TELESCOPE.READY_STATE')
-
-            if ready_state != old_ready_state:
+        # followed only while waiting for it
+        try:
+            while ready_state < 1.0:
                 self.log.debug("Powering up Astelco: %s" % (ready_state))
                 old_ready_state = ready_state
-            if self._abort.set():
-                # Send abort command to astelco
-                self.log.warning("Aborting! This will leave the telescope in an intermediate state!")
-                tpl.set('ABORT', cmdid)
-                return False
-            if time.time() > start_time + self['parktimeout']:
-                self.log.error("Parking operation timedout!")
-                tpl.set('ABORT', cmdid)
-                raise AstelcoException('Unparking telescope timedout.')
-
-            status = self.getTelescopeStatus()
-            if status == AstelcoTelescopeStatus.WARNING or status == AstelcoTelescopeStatus.INFO:
-                self.log.warning("Acknowledging telescope state.")
-                self.logStatus()
-                self.acknowledgeEvents() # This is needed so I can tell the telescope to park
-            elif status == AstelcoTelescopeStatus.ERROR or status == AstelcoTelescopeStatus.PANIC:
-                # When something really bad happens during unpark, telescope needs to be parked
-                # and then, start over.
-                tpl.set('ABORT', cmdid)
-                self.log.critical("Something wrong with the telescope. Aborting...")
-                self.logStatus()
-                # self.acknowledgeEvents() # This is needed so I can tell the telescope to park afterwards
-                errmsg = '''Something wrong happened while trying to unpark the telescope. In most cases this happens
+                ready_state = tpl.waitchange('TELESCOPE.READY_STATE', ready_state, 1.0)
+
+                if ready_state != old_ready_state:
+                    self.log.debug("Powering up Astelco: %s" % (ready_state))
+                    old_ready_state = ready_state
+                if self._abort.set():
+                    # Send abort command to astelco
+                    self.log.warning("Aborting! This will leave the telescope in an intermediate state!")
+                    tpl.set('ABORT', cmdid)
+                    return False
+                if time.time() > start_time + self['parktimeout']:
+                    self.log.error("Parking operation timedout!")
+                    tpl.set('ABORT', cmdid)
+                    raise AstelcoException('Unparking telescope timedout.')
+
+                status = self.getTelescopeStatus()
+                if status == AstelcoTelescopeStatus.WARNING or status == AstelcoTelescopeStatus.INFO:
+                    self.log.warning("Acknowledging telescope state.")
+                    self.logStatus()
+                    self.acknowledgeEvents() # This is needed so I can tell the telescope to park
+                elif status == AstelcoTelescopeStatus.ERROR or status == AstelcoTelescopeStatus.PANIC:
+                    # When something really bad happens during unpark, telescope needs to be parked
+                    # and then, start over.
+                    tpl.set('ABORT', cmdid)
+                    self.log.critical("Something wrong with the telescope. Aborting...")
+                    self.logStatus()
+                    # self.acknowledgeEvents() # This is needed so I can tell the telescope to park afterwards
+                    errmsg = '''Something wrong happened while trying to unpark the telescope. In most cases this happens
                 when one of the submodules (like the hexapod) is not properly loaded or working pressure could not be
                 reached. Waiting a couple of minutes, parking and unparking it again should solve the problem or sending
                 someone there to check on the compressor. If that doesn't work, there may be a more serious problem with
                 the system.'''
-                raise AstelcoException(errmsg)
-
-            time.sleep(.1)
+                    raise AstelcoException(errmsg)
+        finally:
+            tpl.unsubscribe(['TELESCOPE.READY_STATE'])
 
         # 3. set location, date and time
         self._initTelescope()
@@ -1741,33 +1918,165 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
         return tpl.commands_sent
 
     def getSensors(self):
-        return self.sensors
+        '''
+        Get the last sensor readings, kept up to date by a background thread
+        every 'sensors_interval' seconds.
+
+        :return: SensorSnapshot
+        '''
+        return self._sensors
 
-    @lock
     def updateSensors(self):
+        '''
+        Read the sensor values now instead of waiting for the poller.
 
-        sensors = [('SENSTIME','%s'%dt.datetime.now(),"Last time sensors where updated.")]
+        :return: SensorSnapshot
+        '''
 
-        tpl = self.getTPL()
+        self._sensorlock.acquire()
+        try:
+            tpl = self.getTPL()
+
+            if self._sensorlabels is None or self._sensorlabelsstale or \
+                    time.time() - self._sensorlabelstime > self['sensors_labels_interval']:
+                labels, complete = self._readSensorLabels(tpl)
+                if labels is not None:
+                    self._sensorlabels = labels
+                    self._sensorlabelstime = time.time()
+                    self._sensorlabelsstale = not complete
+                    for n, description, unit in self._sensorlabels:
+                        if n not in self._sensorhistory:
+                            self._sensorhistory[n] = SensorHistory(int(self['sensors_history']))
+                elif self._sensorlabels is None:
+                    return self._sensors
+
+            t = time.time()
+            values = tpl.getobjects(['AUXILIARY.SENSOR[%i].VALUE' % n
+                                     for n, description, unit in self._sensorlabels])
+
+            cards = [('SENSTIME', '%s' % dt.datetime.fromtimestamp(t), "Last time sensors where updated.")]
+            for n, description, unit in self._sensorlabels:
+                value = values['AUXILIARY.SENSOR[%i].VALUE' % n]
+                if value is None:
+                    # the sensor may have gone, check the labels next time
+                    self._sensorlabelsstale = True
+                cards.append((description, value, unit))
+                self._sensorhistory[n].append(t, value)
+
+            self._sensors = SensorSnapshot(cards, self._sensors.version + 1, t)
+            return self._sensors
+        finally:
+            self._sensorlock.release()
+
+    def getSensorHistory(self, sensor, start=None, end=None, step=None):
+        '''
+        Get the readings of a sensor kept since the poller started, up to
+        'sensors_history' of them.
+
+        :param sensor: sensor number (n in AUXILIARY.SENSOR[n]) or description.
+        :param start: first time (seconds since the epoch), None from the oldest reading.
+        :param end: last time, None up to the latest reading.
+        :param step: if given, return min/max/mean over windows of step
+                     seconds. It must be positive.
+        :return: list of (time, value) or, with step, of (window start, min,
+                 max, mean, number of readings).
+        '''
+
+        for n, description, unit in self._sensorlabels or []:
+            if sensor == n or sensor == description:
+                break
+        else:
+            raise AstelcoException("No history for sensor '%s'." % sensor)
+
+        history = self._sensorhistory[n]
+
+        if step is not None:
+            return history.downsample(step, start, end)
+
+        times, values = history.samples(start, end)
+        return zip(times.tolist(), values.tolist())
+
+    def _readSensorLabels(self, tpl):
+        '''
+        :return: (labels, complete). labels is a list of (number, description,
+                 unit) of the working sensors, None if no description could
+                 be read. complete is False if some could not be read.
+        '''
+
+        objects = []
+        for n in range(1, int(self["sensors"]) + 1):
+            for field in ('DESCRIPTION', 'UNITY'):
+                objects.append('AUXILIARY.SENSOR[%i].%s' % (n, field))
 
-        for n in range(int(self["sensors"])):
-            description = tpl.getobject('AUXILIARY.SENSOR[%i].DESCRIPTION' % (n + 1))
+        values = tpl.getobjects(objects)
+
+        labels = []
+        read = False
+        complete = True
+        for n in range(1, int(self["sensors"]) + 1):
+            description = values['AUXILIARY.SENSOR[%i].DESCRIPTION' % n]
+            read = read or description is not None
+            complete = complete and description is not None
 
             if not description:
                 continue
             elif "FAILED" in description:
                 continue
 
-            value = tpl.getobject('AUXILIARY.SENSOR[%i].VALUE' % (n + 1))
-            unit = tpl.getobject('AUXILIARY.SENSOR[%i].UNITY' % (n + 1))
-            sensors.append((description, value, unit))
-            # sensors.append((0, 0, 0))
+            labels.append((n, description, values['AUXILIARY.SENSOR[%i].UNITY' % n]))
+
+        if not read:
+            return None, False
+
+        return labels, complete
 
-        self.sensors = sensors
+    def _sensorloop(self):
+
+        while not self._sensorpoller_stop.isSet():
+            try:
+                self.updateSensors()
+            except Exception, e:
+                self.log.warning('Could not read sensors: %s' % e)
+            self._sensorpoller_stop.wait(self['sensors_interval'])
 
     def getMetadata(self, request):
-        lst = self.getLocalSiderealTime()
-        baseHDR = [('TELESCOP', self['model'], 'Telescope Model'),
+
+        return self._metadata(self.getState(0), self.getSensors())
+
+    def _metadata(self, state, sensors):
+        '''
+        Render the FITS header cards from a TelescopeState and a
+        SensorSnapshot, without any TPL request, so that all the cards
+        describe the same instant.
+        '''
+
+        ra = Coord.fromH(state.ra) if state.ra is not None else self._ra
+        dec = Coord.fromD(state.dec) if state.dec is not None else self._dec
+        alt = Coord.fromD(state.alt) if state.alt is not None else self._alt
+        az = Coord.fromD(state.az) if state.az is not None else self._az
+
+        if az is not None and self['azimuth180Correct']:
+            if az.toD() >= 180:
+                az = az - Coord.fromD(180)
+            else:
+                az = az + Coord.fromD(180)
+
+        lst = Coord.fromH(state.lst) if state.lst is not None else None
+        HA = Coord.fromH(state.lst - ra.H) if lst is not None and ra is not None else None
+        RAoffset = Coord.fromD(state.ha_offset) if state.ha_offset is not None else None
+        DECoffset = Coord.fromD(state.dec_offset) if state.dec_offset is not None else None
+
+        # values that could not be read are left blank
+        def hms(coord):
+            return coord.toHMS().__str__() if coord is not None else ''
+
+        def dms(coord):
+            return coord.toDMS().__str__() if coord is not None else ''
+
+        def deg(coord):
+            return coord.D if coord is not None else ''
+
+        return [('TELESCOP', self['model'], 'Telescope Model'),
                 ('OPTICS', self['optics'], 'Telescope Optics Type'),
                 ('MOUNT', self['mount'], 'Telescope Mount Type'),
                 ('APERTURE', self['aperture'], 'Telescope aperture size [mm]'),
@@ -1775,45 +2084,29 @@ class AstelcoTelescope(TelescopeBase):  # converted to Astelco
                  'Telescope focal length [mm]'),
                 ('F_REDUCT', self['focal_reduction'],
                  'Telescope focal reduction'),
-                ('RA', self.getRa().toHMS().__str__(),
+                ('RA', hms(ra),
                  'Right ascension of the observed object'),
-                ('DEC', self.getDec().toDMS().__str__(),
+                ('DEC', dms(dec),
                  'Declination of the observed object'),
                 ("EQUINOX", 2000.0, "coordinate epoch"),
-                ('ALT', self.getAlt().toDMS().__str__(),
+                ('ALT', dms(alt),
                  'Altitude of the observed object'),
-                ('AZ', self.getAz().toDMS().__str__(),
+                ('AZ', dms(az),
                  'Azimuth of the observed object'),
                 ("WCSAXES", 2, "wcs dimensionality"),
                 ("RADESYS", "ICRS", "frame of reference"),
-                ("CRVAL1", self.getRa().D,
+                ("CRVAL1", deg(ra),
                  "coordinate system value at reference pixel"),
-                ("CRVAL2", self.getDec().D,
+                ("CRVAL2", deg(dec),
                  "coordinate system value at reference pixel"),
                 ("CTYPE1", 'RA---TAN', "name of the coordinate axis"),
                 ("CTYPE2", 'DEC--TAN', "name of the coordinate axis"),
                 ("CUNIT1", 'deg', "units of coordinate value"),
-                ("CUNIT2", 'deg', "units of coordinate value")] + self.getSensors()
-
-        ra = None
-        for i in range(len(baseHDR)):
-            if baseHDR[i][0] == "RA":
-                ra = Coord.fromHMS(baseHDR[i][1])
-        if ra is None:
-            ra = self.getRa()
-        HA = lst - ra
-        RAoffset = Coord.fromD(self._getOffset(Direction.E))
-        DECoffset = Coord.fromD(self._getOffset(Direction.N))
-
-        newHDR = [('RAOFFSET',RAoffset.toDMS().__str__(),"Current offset of the telescope in RA (DD:MM:SS.SS)."),
-                  ('DEOFFSET',DECoffset.toDMS().__str__(),"Current offset of the telescope in Declination (DD:MM:SS.SS)."),
-                  ('TEL_LST',lst.toHMS().__str__(),"Local Sidereal Time at the start of the observation (HH:MM:SS.SS)."),
-                  ('TEL_HA',HA.toHMS().__str__(),"Hour Angle at the start of the observation (HH:MM:SS.SS).")]
-
-        for new in newHDR:
-            baseHDR.append(new)
-
-        return baseHDR
+                ("CUNIT2", 'deg', "units of coordinate value")] + list(sensors) + \
+               [('RAOFFSET',dms(RAoffset),"Current offset of the telescope in RA (DD:MM:SS.SS)."),
+                ('DEOFFSET',dms(DECoffset),"Current offset of the telescope in Declination (DD:MM:SS.SS)."),
+                ('TEL_LST',hms(lst),"Local Sidereal Time at the start of the observation (HH:MM:SS.SS)."),
+                ('TEL_HA',hms(HA),"Hour Angle at the start of the observation (HH:MM:SS.SS).")]
 
     #     return [('TELESCOP', self['model'], 'Telescope Model'),
     #             ('OPTICS', self['optics'], 'Telescope Optics Type'),
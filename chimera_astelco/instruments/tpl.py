@@ -21,18 +21,23 @@
 
 import time
 import os
-import numpy as np
 import telnetlib
-from collections import defaultdict
-import re
-import shutil
+from collections import defaultdict, OrderedDict
+import threading
+import Queue
+import select
+import socket
+import fnmatch
 from chimera.core.chimeraobject import ChimeraObject
 from chimera.core.lock import lock
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
 from chimera.core.exceptions import ChimeraException
+from chimera.core.event import event
 from chimera.util.enum import Enum
+from chimera_astelco.util.tpltrace import TraceRecorder
 
 import logging
+import logging.handlers
 
 __all__ = ["TPLBase"]
 
@@ -41,7 +46,11 @@ class TPLException(ChimeraException):
     pass
 
 
-TPLStatus = Enum("CONNECTED", "CLOSED")
+class TPLNotConnected(TPLException):
+    pass
+
+
+TPLStatus = Enum("CONNECTED", "CLOSED", "RECONNECTING")
 
 CMDStatus = Enum("DONE","ABORTED","WAITING","TIMEOUT")
 
@@ -57,7 +66,125 @@ _CmdType['1'] = int
 _CmdType['2'] = float
 _CmdType['3'] = str
 
-class Command():
+# Log level of the wire trace, every line sent to and received from the server
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+class _BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    Size rotated log file flushed by AsyncLogHandler once per batch instead
+    of once per record.
+    '''
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        logging.handlers.RotatingFileHandler.flush(self)
+
+class AsyncLogHandler(logging.Handler):
+    '''
+    Hand log records to a background thread which writes them in batches,
+    keeping disk I/O off the protocol path. Records at TRACE level are
+    sampled, only one of every 'sample' is written. If the writer falls
+    behind by more than 'capacity' records, new ones are dropped and
+    counted.
+    '''
+
+    def __init__(self, target, sample=1, batch=256, capacity=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.sample = max(int(sample), 1)
+        self.batch = batch
+        self.dropped = 0
+        self._count = 0
+        self._queue = Queue.Queue(capacity)
+        self._writer = threading.Thread(target=self._writerloop, name='tpl-log')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def emit(self, record):
+        if record.levelno <= TRACE and self.sample > 1:
+            self._count += 1
+            if self._count % self.sample:
+                return
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _writerloop(self):
+        while True:
+            records = [self._queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            for record in records:
+                if record is None:
+                    self.target.sync()
+                    return
+                self.target.handle(record)
+            self.target.sync()
+
+    def close(self):
+        if self._writer.isAlive():
+            self._queue.put(None)
+            self._writer.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+# Shared by all TPL instances, they all write to the same file
+_debughandler = None
+
+# Reply kinds returned by parseline
+REPLY_INLINE, REPLY_DATAOK, REPLY_COMMAND, REPLY_ERROR = range(4)
+
+def parseline(line):
+    '''
+    Parse a single reply line from the TPL server. Lines are classified by
+    their leading tokens and split in place, no backtracking is needed.
+
+    :param line: reply line without the end of line.
+    :return: (cmdid, kind, object, value) or None if the line is not a
+             command reply. For REPLY_COMMAND, object holds the command
+             status and for REPLY_ERROR, value holds the error message.
+    '''
+
+    fields = line.split(None, 2)
+    if len(fields) < 3 or not fields[0].isdigit():
+        return None
+
+    cmdid, token, rest = fields
+
+    if token == 'DATA':
+        if rest.startswith('INLINE '):
+            obj, sep, value = rest[7:].partition('=')
+            if sep:
+                return int(cmdid), REPLY_INLINE, obj, value
+        elif rest.startswith('OK '):
+            return int(cmdid), REPLY_DATAOK, rest[3:].strip(), None
+    elif token == 'COMMAND':
+        return int(cmdid), REPLY_COMMAND, rest.split(None, 1)[0], None
+    elif token == 'EVENT':
+        if rest.startswith('ERROR '):
+            obj, sep, msg = rest[6:].partition(':')
+            if sep:
+                return int(cmdid), REPLY_ERROR, obj.strip(), msg.strip()
+
+    return None
+
+# Guards Command callbacks, so one added while the command completes is
+# never lost
+_callback_lock = threading.Lock()
+
+class Command(object):
+
+    __slots__ = ('id', 'cmd', 'object', 'received', 'events', 'dtype', 'status',
+                 'allstatus', 'ok', 'complete', 'data', 'values', 'types', 'deadline', '_done',
+                 '_callbacks', '_conn')
 
     def __init__(self):
         self.id = 0
@@ -71,11 +198,345 @@ class Command():
         self.ok = False
         self.complete = False
         self.data = []
+        self.values = {}
+        # types of the objects requested without !TYPE, as known when sent
+        self.types = {}
+        self.deadline = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._conn = None
+
+    def __getstate__(self):
+        # Events and callbacks can not be pickled, drop them when sending
+        # commands over Pyro
+        return dict([(name, getattr(self, name)) for name in self.__slots__
+                     if not name.startswith('_')])
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._done = threading.Event()
+        self._callbacks = []
+        self._conn = None
+        if self.complete:
+            self._done.set()
+
+    def finish(self):
+        '''
+        Mark command as complete and wake up anyone waiting on it.
+
+        :return: list of callbacks to be called with this command.
+        '''
+        _callback_lock.acquire()
+        try:
+            self.complete = True
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            _callback_lock.release()
+        self._done.set()
+        return callbacks
+
+    def addCallback(self, callback):
+        '''
+        Call callback(command) once the command completes, right away if it
+        already has.
+        '''
+        _callback_lock.acquire()
+        try:
+            if not self.complete:
+                self._callbacks.append(callback)
+                return
+        finally:
+            _callback_lock.release()
+        callback(self)
+
+    def wait(self, timeout=None):
+        '''
+        Block until the command completes or timeout (in seconds) expires.
 
+        :return: True if command completed, False otherwise.
+        '''
+        return self._done.wait(timeout)
+
+    def failed(self):
+        return not self.ok or len(self.events) > 0
 
     def __str__(self):
         return str(self.id) + ' ' + self.cmd + ' ' + self.object + '\r\n'
 
+class CommandHistory(object):
+    '''
+    Fixed capacity history of the commands sent, indexed by command id. Ids
+    are sequential, so a new command simply takes the slot of the one sent
+    'size' commands before it.
+    '''
+
+    def __init__(self, size):
+        self._size = max(int(size), 1)
+        self._slots = [None] * self._size
+
+    def __setitem__(self, cmdid, cmd):
+        self._slots[cmdid % self._size] = cmd
+
+    def __getitem__(self, cmdid):
+        cmd = self.get(cmdid)
+        if cmd is None:
+            raise KeyError(cmdid)
+        return cmd
+
+    def __contains__(self, cmdid):
+        return self.get(cmdid) is not None
+
+    def __len__(self):
+        return len(self.values())
+
+    def get(self, cmdid, default=None):
+        cmd = self._slots[cmdid % self._size]
+        if cmd is None or cmd.id != cmdid:
+            return default
+        return cmd
+
+    def values(self):
+        return sorted([cmd for cmd in self._slots if cmd is not None],
+                      key=lambda cmd: cmd.id)
+
+    def keys(self):
+        return [cmd.id for cmd in self.values()]
+
+    def items(self):
+        return [(cmd.id, cmd) for cmd in self.values()]
+
+class TPLConnection(object):
+    '''
+    One authenticated connection to the TPL server and the thread reading
+    its replies. Replies are handed to the owner TPL, which keeps track of
+    the commands.
+    '''
+
+    def __init__(self, tpl, name='tpl-reader'):
+        self.tpl = tpl
+        self.name = name
+        self.sock = None
+        self.status = TPLStatus.CLOSED
+
+        # commands sent through this connection and not completed yet
+        self.inflight = 0
+
+        # Receive buffer, holds incomplete lines between reads
+        self._rbuf = ''
+
+        # Reader thread
+        self._reader = None
+        self._reader_stop = threading.Event()
+
+        # Only one message at a time on the wire, also guards status
+        self._wlock = threading.Lock()
+
+    def connect(self):
+        '''
+            Connect to tpl server
+        '''
+
+        self._open()
+
+        # Start reading replies
+        self._reader_stop = threading.Event()
+        self._reader = threading.Thread(target=self._readerloop,
+                                        args=(self.sock, self._reader_stop),
+                                        name=self.name)
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+    def _open(self):
+        '''
+            Open the socket and authenticate
+        '''
+
+        tpl = self.tpl
+
+        # Drop leftovers from a previous connection
+        self._rbuf = ''
+
+        # Open the socket. Keepalive lets the reader notice links that die
+        # silently.
+        self.sock = telnetlib.Telnet(tpl['tpl_host'], tpl['tpl_port'], tpl['timeout'])
+        self.sock.get_socket().setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        # Read in welcome message up to the end
+        s = self.sock.expect(['TPL2\s+(?P<TPL2>\S+)\s+CONN\s+(?P<CONN>\d+)\s+AUTH\s+(?P<AUTH>\S+(,\S+)*)\s+'
+                        'ENC MESSAGE (?P<ENCM>(.*?)\s*\\n)'],
+                             timeout=tpl['timeout'])
+        if not s[1]:
+            self.sock.close()
+            raise TPLException(
+                'self.sock.connect((' + tpl['tpl_host'] + str(tpl['tpl_port']) + ')', 'Got None as answer.')
+
+        # parse information
+        self.protocol_version, self.conn, self.auth_methods, self.encmsg = s[1].group(
+            'TPL2'), s[1].group('CONN'), s[1].group('AUTH'), s[1].group('ENCM')
+
+        # Sends credentials
+        tpl._debuglog.debug('AUTH PLAIN "' + tpl["user"] + '" "****"')
+        self.sock.write('AUTH PLAIN "' + tpl["user"] + '" "' + tpl["password"] + '"\r\n')
+        s = self.sock.expect(['AUTH\s+(?P<AUTH>\S+)\s+(?P<read_level>\d)\s+(?P<write_level>\d)\n'],
+                             timeout=tpl['timeout'])
+
+        if (not s[1]) or (s[1].group('AUTH') != 'OK'):
+            self.sock.close()
+            raise TPLException('Not authorized.')
+
+        self.read_level, self.write_level = int(
+            s[1].group('read_level')), int(s[1].group('write_level'))
+
+        self._wlock.acquire()
+        self.status = TPLStatus.CONNECTED
+        self._wlock.release()
+
+    def disconnect(self):
+        '''
+            Disconnect from tpl server
+        '''
+
+        self._wlock.acquire()
+        self.status = TPLStatus.CLOSED
+        self._wlock.release()
+
+        # self.send('DISCONNECT')
+        if self._reader is not None:
+            self._reader_stop.set()
+        if self.sock is not None:
+            self.sock.close()
+        if self._reader is not None and self._reader is not threading.currentThread():
+            self._reader.join(self.tpl['timeout'])
+        self._reader = None
+
+    def write(self, message):
+        self._wlock.acquire()
+        try:
+            if self.status != TPLStatus.CONNECTED:
+                raise TPLNotConnected('Connection %s is %s.' % (self.name, self.status))
+            self.sock.write(message)
+            if self.tpl._trace is not None:
+                self.tpl._trace.record('tx', self.name, message.rstrip('\r\n'))
+        finally:
+            self._wlock.release()
+
+    def drop(self):
+        '''
+        Shut the socket down, as if the server had closed it. The reader
+        notices it and reconnects.
+        '''
+        try:
+            self.sock.get_socket().shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+    def _reconnect(self, stop):
+        '''
+        Reopen a lost connection, waiting longer after each failed attempt.
+
+        :return: the new socket, None if the connection was closed meanwhile.
+        '''
+
+        tpl = self.tpl
+
+        self._wlock.acquire()
+        self.status = TPLStatus.RECONNECTING
+        self._wlock.release()
+
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+        tpl._connectionlost(self)
+
+        delay = tpl['reconnect_min']
+
+        while not stop.isSet():
+            try:
+                self._open()
+            except Exception, e:
+                tpl.log.warning('[reader] Could not reconnect %s (%s), retrying in %.1f s.' % (self.name, e, delay))
+                stop.wait(delay)
+                delay = min(delay * 2, tpl['reconnect_max'])
+            else:
+                tpl._reconnected(self)
+                return self.sock
+
+        return None
+
+    def _readerloop(self, sock, stop):
+        '''
+        Reader thread main loop. Block on the socket and dispatch every reply
+        as soon as it arrives.
+        '''
+
+        tpl = self.tpl
+
+        tpl._debuglog.debug('[reader] starting...')
+
+        while not stop.isSet():
+            try:
+                # there may be data already cooked by telnetlib (e.g. left
+                # over from the handshake), so only block if there is none
+                if not sock.sock_avail() and not sock.cookedq:
+                    ready, _, _ = select.select([sock.get_socket()], [], [], tpl['waittime'])
+                    if not ready:
+                        continue
+                tpl.dispatch(self.expect(sock))
+            except (EOFError, socket.error, select.error), e:
+                if stop.isSet():
+                    break
+                tpl.log.warning('[reader] Connection %s lost (%s), reconnecting...' % (self.name, e or 'closed by server'))
+                sock = self._reconnect(stop)
+                if sock is None:
+                    break
+            except Exception, e:
+                if stop.isSet():
+                    break
+                tpl.log.error('[reader] Error reading from TPL server.')
+                tpl.log.exception(e)
+                stop.wait(tpl['waittime'])
+
+        tpl._debuglog.debug('[reader] done')
+
+    def expect(self, sock=None):
+
+        if sock is None:
+            sock = self.sock
+
+        # start with whatever was left incomplete from the last read
+        chunks = [self._rbuf]
+        recv = sock.read_very_eager()
+        while recv != '':
+            chunks.append(recv)
+            recv = sock.read_very_eager()
+
+        lines = ''.join(chunks).split('\n')
+
+        # the last element is an incomplete line (or empty if the data ended
+        # with a new line), keep it until the rest of it arrives
+        self._rbuf = lines.pop()
+
+        ret = []
+        trace = self.tpl._trace
+
+        for line in lines:
+
+            line = line.rstrip('\r')
+            if len(line) < 1:
+                continue
+            if trace is not None:
+                trace.record('rx', self.name, line)
+            reply = parseline(line)
+            if reply is not None:
+                ret.append(reply + (line,))
+            else:
+                self.tpl._debuglog.debug('[expect] Ignoring line: %s' % line)
+
+        return ret
+
 class TPL(ChimeraObject):
 
     __config__ = {"device": '/dev/ttyS0',
@@ -84,150 +545,230 @@ class TPL(ChimeraObject):
                   "user": 'admin',
                   "password": 'admin',
                   "freq": 2.,
-                  "timeout": 60,
+                  "timeout": 60,  # deadline (s) of SETs, also used when connecting
+                  "get_timeout": 1.,  # deadline (s) of GETs
+                  "slow_timeout": 600.,  # deadline (s) of SETs to slow_objects
                   "waittime": 0.5,
-                  "history" : 1000}
+                  "history" : 1000,
+                  "subscribe_freq": 4.,  # refresh rate of subscribed objects (Hz)
+                  "keep_received": False,  # keep received lines of successful commands
+                  "connections": 1,  # number of connections to the server
+                  "reconnect_min": 0.5,  # first wait (s) before reconnecting, doubled at each failure
+                  "reconnect_max": 30.,  # longest wait (s) between reconnection attempts
+                  # SETs that take long to complete. They get 'slow_timeout' and, with more
+                  # than one connection, go through the first one and everything else
+                  # through the others.
+                  "slow_objects": 'POINTING.TRACK,TELESCOPE.READY,POINTING.MODEL.CALCULATE,'
+                                  'POSITION.INSTRUMENTAL.FOCUS*.OFFSET,AUXILIARY.DOME.TARGETPOS,'
+                                  'AUXILIARY.COVER.TARGETPOS',
+                  # Read-through cache of getobject/getobjects, as a list of
+                  # pattern=ttl (s). Empty disables it.
+                  "cache_ttl": 'TELESCOPE.CONFIG.*=600,POINTING.SETUP.LOCAL.*=600',
+                  "log_maxbytes": 10 * 1024 * 1024,  # tpl.log is rotated at this size
+                  "log_backups": 5,  # number of rotated tpl.log kept
+                  # write one of every log_sample lines of the wire trace, 0 disables it
+                  "log_sample": 1,
+                  # NDJSON trace of every line sent and received (relative to the
+                  # configuration directory), see util/tpltrace. Empty disables it.
+                  "trace_file": ''}
 
     def __init__(self):
 
         ChimeraObject.__init__(self)
 
-        # debug log
+        # debug log, set up on __start__ when the configuration is known
         # self._debugLog = None
         self._debuglog = logging.getLogger('_tpldebug_')
-        logfile = os.path.join(SYSTEM_CONFIG_DIRECTORY, "tpl.log")
-        if os.path.exists(logfile):
-            shutil.move(logfile, os.path.join(SYSTEM_CONFIG_DIRECTORY,
-                                              "tpl.log_%s"%time.strftime("%Y%m%d-%H%M%S")))
-
-        _log_handler = logging.FileHandler(logfile)
-        _log_handler.setFormatter(logging.Formatter(fmt='%(asctime)s[%(levelname)s:%(threadName)s]-%(name)s-(%(filename)s:%(lineno)d):: %(message)s'))
-        # _log_handler.setLevel(logging.DEBUG)
-        self._debuglog.setLevel(logging.DEBUG)
-        self._debuglog.addHandler(_log_handler)
+        self._debuglog.propagate = False
         self.log.setLevel(logging.INFO)
 
         # Command counter
         self.next_command_id = 1
-        self.last_cmd_deleted = 0
 
         # Store received objects
-        self.commands_sent = {}
-
-        self._expect = [ '(?P<CMDID>\d+) DATA INLINE (?P<OBJECT>\S+)=(?P<VALUE>.+)',
-                         '(?P<CMDID>\d+) DATA OK (?P<OBJECT>\S+)',
-                         '(?P<CMDID>\d+) COMMAND (?P<STATUS>\S+)',
-                         '(?P<CMDID>\d+) EVENT ERROR (?P<OBJECT>\S+):(?P<ENCM>(.*?)\s*)']
-
+        self.commands_sent = CommandHistory(self["history"])
+
+        # Commands still waiting for COMMAND COMPLETE, by id. Kept apart from
+        # the history so that checking for pending commands is cheap.
+        self._pending = {}
+
+        # Long running commands that were already out of the history when
+        # they completed, oldest first. Kept so they can still be looked up.
+        self._completed = OrderedDict()
+
+        # Object types do not change during a session, so only ask for
+        # them once per connection.
+        self._types = {}
+
+        # Connection pool and the lock guarding its in-flight counters
+        self._connections = []
+        self._routelock = threading.Lock()
+        self._slowobjects = []
+
+        # Cached object values, object -> (value, time read). Kept for the
+        # objects matching a 'cache_ttl' pattern, whose ttl is memoized in
+        # _ttls.
+        self._cache = {}
+        self._cachettl = []
+        self._ttls = {}
+
+        # Subscribed objects, their last value and number of subscribers.
+        # Anyone waiting for a value to change waits on _subcond or leaves a
+        # callback in _subcallbacks.
+        self._subscribed = {}
+        self._subcount = defaultdict(int)
+        self._subcallbacks = defaultdict(list)
+        self._subcond = threading.Condition()
+        self._subcmd = None
+        self._subscriber = None
+        self._subscriber_stop = threading.Event()
+
+        # Wire trace recorder, when 'trace_file' is set
+        self._trace = None
 
     def __start__(self):
 
         self.setHz(self['freq'])
 
+        self.commands_sent = CommandHistory(self["history"])
+        self._completed.clear()
+
+        self._slowobjects = [obj.strip() for obj in self['slow_objects'].split(',') if obj.strip()]
+
+        self._cachettl = []
+        self._ttls.clear()
+        for entry in self['cache_ttl'].split(','):
+            if not entry.strip():
+                continue
+            pattern, sep, ttl = entry.partition('=')
+            try:
+                self._cachettl.append((pattern.strip(), float(ttl)))
+            except ValueError:
+                self.log.warning('Invalid cache_ttl entry "%s", ignoring it.' % entry)
+
+        self._startdebuglog()
+
+        if self['trace_file']:
+            self._trace = TraceRecorder(os.path.join(SYSTEM_CONFIG_DIRECTORY, self['trace_file']))
+
         self._debuglog.debug('tpl START')
         self.open()
 
+        self._subscriber_stop.clear()
+        self._subscriber = threading.Thread(target=self._subscriberloop,
+                                            name='tpl-subscriber')
+        self._subscriber.setDaemon(True)
+        self._subscriber.start()
+
         return True
 
     def __stop__(self):
         self._debuglog.debug('tpl STOP')
+        self._subscriber_stop.set()
+        if self._subscriber is not None:
+            self._subscriber.join(self['timeout'])
         self.close()
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+    def _startdebuglog(self):
+        '''
+        Write the debug log (tpl.log) from a background thread, rotating it
+        by size.
+        '''
+
+        global _debughandler
+
+        if _debughandler is None:
+            target = _BatchRotatingFileHandler(os.path.join(SYSTEM_CONFIG_DIRECTORY, "tpl.log"),
+                                               maxBytes=int(self['log_maxbytes']),
+                                               backupCount=int(self['log_backups']))
+            target.setFormatter(logging.Formatter(fmt='%(asctime)s[%(levelname)s:%(threadName)s]-%(name)s-(%(filename)s:%(lineno)d):: %(message)s'))
+            _debughandler = AsyncLogHandler(target)
+            self._debuglog.addHandler(_debughandler)
+
+        if self['log_sample'] > 0:
+            _debughandler.sample = int(self['log_sample'])
+            self._debuglog.setLevel(TRACE)
+        else:
+            self._debuglog.setLevel(logging.DEBUG)
 
     @lock
     def control(self):
 
-        # self._debuglog.debug('[control] entering...')
+        # Replies are dispatched by the reader thread as soon as they
+        # arrive and the command history is bounded by itself.
 
-        # check if there is any incomplete command
-        incomplete = np.any(np.array([not cmd.complete for cmd in self.commands_sent.values()]))
-        if incomplete:
-            self._debuglog.debug('[control] TPL has incomplete commands')
-            for cmd in self.commands_sent.values():
-                if not cmd.complete:
-                    self._debuglog.debug('[control] Command %i not complete'%cmd.id)
-        else:
-            return True
+        if self._pending:
+            self._debuglog.debug('[control] TPL has %i incomplete commands' % len(self._pending))
+
+        return True
+
+    def dispatch(self, exp_recv):
 
-        exp_recv = self.expect()
-        self._debuglog.debug('[control] Received %i commands'%len(exp_recv))
+        trace = self._debuglog.isEnabledFor(TRACE)
 
-        for i in range(len(exp_recv)):
-            recv = exp_recv[i]
+        for cmdid, kind, obj, value, line in exp_recv:
 
-            self._debuglog.debug(recv[2])
-            cmdid = int(recv[1].group('CMDID'))
-            if not cmdid in self.commands_sent.keys():
-                self.log.warning('Received a bad command id %i. Skipping'%cmdid)
+            if trace:
+                self._debuglog.log(TRACE, line)
+            # a slow command may already be out of the history
+            cmd = self._lookup(cmdid)
+            if cmd is None:
+                if cmdid < self.next_command_id:
+                    # late reply to a command long gone, e.g. an expired GET
+                    self._debuglog.debug('[dispatch] Late reply to command %i. Skipping' % cmdid)
+                else:
+                    self.log.warning('Received a bad command id %i. Skipping'%cmdid)
                 continue
 
-            self.commands_sent[cmdid].received.append(recv[2])
+            cmd.received.append(line)
 
             try:
-                if 'DATA INLINE' in recv[2]:
-                    if '!TYPE' in recv[2]:
-                        self.commands_sent[cmdid].dtype = _CmdType[recv[1].group('VALUE')]
+                if kind == REPLY_INLINE:
+                    if obj.endswith('!TYPE'):
+                        cmd.dtype = _CmdType[value]
+                        self._types[obj[:-5]] = cmd.dtype
                     else:
-                        self.commands_sent[cmdid].data.append(self.commands_sent[cmdid].dtype(recv[1].group('VALUE').replace('"','')))
-                elif 'COMMAND' in recv[2]:
-                    self.commands_sent[cmdid].status = recv[1].group('STATUS')
-                    self.commands_sent[cmdid].allstatus.append(recv[1].group('STATUS'))
-                    if self.commands_sent[cmdid].status == 'OK':
-                        self.commands_sent[cmdid].ok = True
-                    elif self.commands_sent[cmdid].status == 'COMPLETE':
-                        self.commands_sent[cmdid].complete = True
-
-                elif 'EVENT ERROR' in recv[2]:
-                    self.commands_sent[cmdid].events.append(recv[1].group('ENCM'))
+                        try:
+                            dtype = self._types.get(obj) or cmd.types.get(obj) or cmd.dtype
+                            value = dtype(value.replace('"',''))
+                        except ValueError:
+                            # do not spoil the remaining objects of a batch
+                            self.log.warning('[dispatch] Could not convert %s' % line)
+                            cmd.values[obj] = None
+                        else:
+                            cmd.data.append(value)
+                            cmd.values[obj] = value
+                            if self._cachettl and self._ttl(obj):
+                                self._cache[obj] = (value, time.time())
+                            if obj in self._subscribed:
+                                self._updatesubscribed(obj, value)
+                elif kind == REPLY_DATAOK:
+                    # object was set, whatever we had is stale
+                    self._cache.pop(obj, None)
+                elif kind == REPLY_COMMAND:
+                    cmd.allstatus.append(obj)
+                    if cmd.complete:
+                        # expired or aborted, keep the status it got then
+                        continue
+                    cmd.status = obj
+                    if cmd.status == 'OK':
+                        cmd.ok = True
+                    elif cmd.status == 'COMPLETE':
+                        self._finish(cmd)
+
+                elif kind == REPLY_ERROR:
+                    cmd.events.append(value)
 
             except Exception,e:
-                self.log.error('[control] Error on command: %s'%(recv[2][:-1]))
-                self.commands_sent[cmdid].ok = False
-                self.commands_sent[cmdid].complete = True
+                self.log.error('[dispatch] Error on command: %s'%(line))
+                cmd.ok = False
+                self._finish(cmd)
                 self.log.exception(e)
                 pass
 
-            # incomplete = np.any(np.array([not cmd.complete for cmd in self.commands_sent.values()]))
-
-        # Check size of commands and clear history
-        while len(self.commands_sent) > int(self["history"]):
-            self.last_cmd_deleted += 1
-            self._debuglog.debug('[control] Cleaning command history. Deleting cmd with id: %i'%self.last_cmd_deleted)
-            self.commands_sent.pop(self.last_cmd_deleted)
-
-        # self._debuglog.debug('[control] Received %i commands'%nrec)
-        # for cmd in self.commands_sent.values():
-        #     msg = '%s %s %s'%(cmd.id,cmd.status,cmd.allstatus)
-        #     self._debuglog.debug(msg)
-        self._debuglog.debug('[control] Done')
-
-        return True
-
-    def expect(self):
-
-        buff = ''
-        recv = None
-        while recv != '':
-            recv = self.sock.read_very_eager()
-            buff+=recv
-
-        buff = buff.split('\n')
-        ret = []
-
-        for line in buff:
-
-            if len(line) < 1:
-                continue
-            for exp in self._expect:
-                re_exp = re.search(exp,line)
-                if re_exp:
-                    ret.append((0,re_exp,line))
-                    break
-
-        return ret
-        #return buff
-        #return self.sock.expect(self._expect,
-        #                        timeout=self['timeout'])
-
     @lock
     def open(self):  # converted to Astelco
         self.log.info('Connecting to TSI server @ %s:%i' % (self["tpl_host"],
@@ -246,57 +787,150 @@ class TPL(ChimeraObject):
             Connect to tpl server
         '''
 
-        # Open the socket
-        self.sock = telnetlib.Telnet(self['tpl_host'], self['tpl_port'], self['timeout'])
+        # Types may have changed if the server was restarted
+        self._types.clear()
+        self._cache.clear()
 
-        # Read in welcome message up to the end
-        s = self.sock.expect(['TPL2\s+(?P<TPL2>\S+)\s+CONN\s+(?P<CONN>\d+)\s+AUTH\s+(?P<AUTH>\S+(,\S+)*)\s+'
-                        'ENC MESSAGE (?P<ENCM>(.*?)\s*\\n)'],
-                             timeout=self['timeout'])
-        if not s:
-            self.sock.close()
-            raise TPLException(
-                'self.sock.connect((' + self.host + str(self.port) + ')', 'Got None as answer.')
+        self._connections = [TPLConnection(self, 'tpl-reader-%i' % i)
+                             for i in range(max(int(self['connections']), 1))]
+        for conn in self._connections:
+            conn.connect()
 
-        # parse information
-        self.protocol_version, self.conn, self.auth_methods, self.encmsg = s[1].group(
-            'TPL2'), s[1].group('CONN'), s[1].group('AUTH'), s[1].group('ENCM')
+    def disconnect(self):
+        '''
+            Disconnect from tpl server
+        '''
+        self.log.info( "Disconnecting from %s:%s"%( self['tpl_host'], self['tpl_port']))
 
-        # Sends credentials
-        self.send('AUTH PLAIN "' + self["user"] + '" "' + self["password"] + '"\r\n')
-        s = self.sock.expect(['AUTH\s+(?P<AUTH>\S+)\s+(?P<read_level>\d)\s+(?P<write_level>\d)\n'],
-                             timeout=self['timeout'])
+        for conn in self._connections:
+            conn.disconnect()
 
-        if (not s[1]) or (s[1].group('AUTH') != 'OK'):
-            self.sock.close()
-            raise TPLException('Not authorized.')
+        # nothing will arrive anymore, release waiters
+        for cmd in self._pending.values():
+            self._finish(cmd, CMDStatus.ABORTED)
 
-        self.read_level, self.write_level = int(
-            s[1].group('read_level')), int(s[1].group('write_level'))
+    def _connectionlost(self, conn):
+        '''
+        Called by the reader of a lost connection. SETs in flight can not
+        be safely sent again and fail right away, GETs stay pending and are
+        sent again once the connection is back.
+        '''
 
-    def disconnect(self):
+        for cmd in self._pending.values():
+            if cmd._conn is conn and cmd.cmd != 'GET':
+                cmd.events.append('CONNECTION LOST')
+                self._finish(cmd, CMDStatus.ABORTED)
+
+    def _reconnected(self, conn):
         '''
-            Disconnect from tpl server
+        Called by the reader once a lost connection is back. Resend the GETs
+        it had in flight. Subscriptions are refreshed by the subscriber as
+        soon as its pending GET completes.
         '''
-        self.log.info( "Disconnecting from %s:%s"%( self['tpl_host'], self['tpl_port']))
 
-        # self.send('DISCONNECT')
-        self.sock.close()
+        replay = sorted([cmd for cmd in self._pending.values()
+                         if cmd._conn is conn and cmd.cmd == 'GET'],
+                        key=lambda cmd: cmd.id)
+
+        # the server may have been restarted, types and values may have
+        # changed while we were away
+        self._types.clear()
+        self._cache.clear()
+
+        for cmd in replay:
+            # the waiters are still there, give them a full deadline again
+            cmd.deadline = time.time() + self['get_timeout']
+            # types were forgotten, ask for them again
+            cmd.object = ';'.join([self._request(obj) for obj in cmd.object.split(';')
+                                   if not obj.endswith('!TYPE')])
+            # drop whatever arrived before the connection was lost
+            cmd.received = []
+            cmd.events = []
+            cmd.status = None
+            cmd.allstatus = []
+            cmd.ok = False
+            cmd.data = []
+            cmd.values = {}
+            if self.send(cmd, conn) != SEND.OK:
+                # lost again, the rest will be sent on the next reconnection
+                break
 
+        self.log.info('Reconnected %s, %i commands sent again.' % (conn.name, len(replay)))
+
+        self.reconnected(conn.name)
+
+    @event
+    def reconnected(self, connection):
+        '''
+        Fired when a lost connection to the server is back.
+
+        :param connection: name of the connection.
+        '''
+        pass
     @lock
     def getNextID(self):
         ocmid = self.next_command_id
         self.next_command_id+=1
         return ocmid
 
+    def _finish(self, cmd, status=None):
+        '''
+        Complete a command, release its waiters and call its callbacks.
+
+        :param status: if given, overrides the command status.
+        :return: False if the command was already complete.
+        '''
+        if self._pending.pop(cmd.id, None) is None:
+            return False
+        if status is not None:
+            cmd.status = status
+        if self.commands_sent.get(cmd.id) is not cmd:
+            # it outlived its slot, keep it where getCmd can still find it
+            self._routelock.acquire()
+            self._completed[cmd.id] = cmd
+            while len(self._completed) > self["history"]:
+                self._completed.popitem(last=False)
+            self._routelock.release()
+        if cmd._conn is not None:
+            self._routelock.acquire()
+            cmd._conn.inflight -= 1
+            self._routelock.release()
+        if not self["keep_received"] and not cmd.failed():
+            cmd.received = []
+        for callback in cmd.finish():
+            self._callback(callback, cmd)
+        return True
+
+    def _callback(self, callback, *args):
+        # callbacks are user code running on the reader thread, never let
+        # them kill it
+        try:
+            callback(*args)
+        except Exception, e:
+            self.log.error('Error in callback %s.' % callback)
+            self.log.exception(e)
+
+    def _lookup(self, cmdid):
+        cmd = self._pending.get(cmdid)
+        if cmd is None:
+            cmd = self.commands_sent.get(cmdid)
+        if cmd is None:
+            cmd = self._completed.get(cmdid)
+        return cmd
+
     def getCmd(self,cmdid):
-        if cmdid in self.commands_sent.keys():
-            return self.commands_sent[cmdid]
+        cmd = self._lookup(cmdid)
+        if cmd is not None:
+            return cmd
         else:
             self.log.warning('cmdid %s does not exists.'%cmdid)
             return None
 
-    def sendcomm(self, comm, object):
+    def sendcomm(self, comm, object, callback=None):
+
+        return self._sendcomm(comm, object, callback).id
+
+    def _sendcomm(self, comm, object, callback=None, timeout=None, conn=None):
 
         cmd = Command()
         cmd.id = self.getNextID()
@@ -304,77 +938,237 @@ class TPL(ChimeraObject):
         cmd.object = object
         cmd.data = []
         cmd.allstatus = []
+        if comm == 'GET':
+            # keep the types this request relies on, in case they are
+            # forgotten on a reconnection before the answer arrives
+            for obj in object.split(';'):
+                if obj in self._types:
+                    cmd.types[obj] = self._types[obj]
+        if callback is not None:
+            cmd.addCallback(callback)
+
+        slow = comm == 'SET' and self._isslow(object)
+
+        if timeout is None:
+            timeout = self['slow_timeout'] if slow else self['timeout'] if comm == 'SET' else self['get_timeout']
+        cmd.deadline = time.time() + timeout
+
+        if conn is None:
+            conn = self._route(slow)
+        cmd._conn = conn
+        self._routelock.acquire()
+        cmd._conn.inflight += 1
+        self._routelock.release()
 
         self.commands_sent[cmd.id] = cmd
-        status = self.send(cmd)
+        self._pending[cmd.id] = cmd
+        status = self.send(cmd, cmd._conn)
 
         if status != SEND.OK:
-            self.commands_sent[cmd.id].status = status
-            return cmd.id
+            if comm == 'GET' and cmd._conn.status != TPLStatus.CLOSED:
+                # still pending, it is sent again once the connection is back
+                return cmd
+            # nothing will ever arrive for this command, release waiters
+            self._finish(cmd, status)
+            return cmd
 
         # if comm in ('GET', 'SET'):
         #     self.commands_sent[cmd.id].data = False
 
-        return cmd.id
+        return cmd
+
+    def _route(self, slow):
+        '''
+        Choose the connection for a command. Slow SETs go through the first
+        connection, so they never hold up reads, which go through the least
+        busy of the others.
+        '''
+
+        if slow or len(self._connections) == 1:
+            return self._connections[0]
+
+        return min(self._connections[1:], key=lambda conn: conn.inflight)
+
+    def _isslow(self, object):
+        '''
+        Whether a SET is to one of 'slow_objects'.
+        '''
+
+        name = str(object).split('=', 1)[0]
+        for pattern in self._slowobjects:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def _wait(self, cmd, timeout=None):
+        '''
+        Wait for a command until its deadline, or timeout (in seconds) if
+        it is shorter. A command past its deadline is expired.
+
+        :return: True if the command completed.
+        '''
+
+        remaining = cmd.deadline - time.time()
+        if timeout is not None and timeout < remaining:
+            remaining = timeout
+
+        if cmd.wait(max(remaining, 0.)):
+            return True
+
+        if time.time() >= cmd.deadline:
+            self._expire(cmd)
+            return cmd.status == 'COMPLETE'
+
+        self.log.warning('Command %i timed out...'%(cmd.id))
+        return False
+
+    def _expire(self, cmd):
+        if self._finish(cmd, CMDStatus.TIMEOUT):
+            self.log.warning('Command %i expired...'%(cmd.id))
+
+    def _sweep(self):
+        '''
+        Expire commands past their deadline, even if nobody waits for them.
+        '''
+        now = time.time()
+        for cmd in self._pending.values():
+            if cmd.cmd == 'GET' and cmd._conn is not None and \
+                    cmd._conn.status == TPLStatus.RECONNECTING:
+                # sent again with a new deadline once the connection is back
+                continue
+            if cmd.deadline is not None and now >= cmd.deadline:
+                self._expire(cmd)
+
+    def abort(self, cmdid):
+        '''
+        Cancel a command. Its waiters are released right away and the server
+        is asked to abort it.
+
+        :return: False if the command was already complete.
+        '''
+
+        cmd = self.getCmd(cmdid)
+
+        if cmd is None or not self._finish(cmd, CMDStatus.ABORTED):
+            return False
+
+        self.log.info('Aborting command %i...' % cmd.id)
+
+        if cmd._conn is not None:
+            # the server only knows the command on its own connection
+            self._sendcomm('ABORT', str(cmd.id), conn=cmd._conn)
+
+        return True
+
+    def waitcmd(self, cmdid, timeout=None):
+        '''
+        Wait for a command to complete, until its deadline or timeout (in
+        seconds) if it is shorter.
+
+        :return: True if the command completed successfully.
+        '''
+
+        cmd = self.getCmd(cmdid)
+        if cmd is None:
+            return False
+
+        return self._wait(cmd, timeout) and cmd.status == 'COMPLETE'
+
+    def send(self, message='\r\n', conn=None):
 
-    def send(self, message='\r\n'):
+        if conn is None:
+            conn = self._connections[0]
 
-        msg = '%s'%(message)
-        self._debuglog.debug( msg[:-1] )
+        if self._debuglog.isEnabledFor(TRACE):
+            msg = '%s'%(message)
+            self._debuglog.log(TRACE, msg[:-1])
 
         try:
-            self.sock.write('%s'%message)
+            conn.write('%s'%message)
+        except TPLNotConnected, e:
+            # already being reconnected (or closed), leave its socket alone
+            self.log.debug('Could not send command through %s: %s' % (conn.name, e))
+            return SEND.ERROR
         except Exception, e:
-            self.log.exception(e)
-            self.log.warning('Reseting connection...')
-            self.close()
-            self.open()
-            try:
-                self.sock.write('%s'%message)
-            except Exception, e:
-                self.log.exception(e)
-                return SEND.ERROR
+            self.log.warning('Could not send command through %s: %s' % (conn.name, e))
+            # make sure the reader notices it and reconnects
+            conn.drop()
+            return SEND.ERROR
 
         return SEND.OK
 
 
-    def get(self, object, wait=False):
+    def get(self, object, wait=False, timeout=None):
+
+        return self._get(object, wait, timeout).id
 
-        ret = self.sendcomm('GET', object)
+    def _get(self, object, wait=False, timeout=None):
+
+        cmd = self._sendcomm('GET', object, timeout=timeout)
 
         if wait:
-            start = time.time()
-            while self.commands_sent[ret].status != 'COMPLETE':
-                if time.time() > start+self['timeout']:
-                    self.log.warning('Command %i timed out...'%(ret))
-                    break
-                continue
+            self._wait(cmd)
 
-        return ret
+        return cmd
+
+    def set(self, object, value, wait=False, binary=False, timeout=None):
+        '''
+        Set an object.
+
+        :param wait: wait for the command to complete.
+        :param timeout: deadline (in seconds) of the command, defaults to
+                        'timeout' or 'slow_timeout' for slow objects.
+        :return: command id.
+        '''
+
+        cmd = self._set(object, value, binary, timeout=timeout)
+
+        if wait:
+            self._wait(cmd)
 
-    def set(self, object, value, wait=False, binary=False):
+        return cmd.id
+
+    def set_async(self, object, value, callback=None, timeout=None):
+        '''
+        Set an object without waiting for it to complete.
+
+        :param callback: if given, callback(ok) is called when the command
+                         completes, ok is True if it succeeded. It runs on
+                         the reader thread and must not block. Callbacks can
+                         not be passed through a Pyro proxy.
+        :param timeout: deadline (in seconds) of the command, see set.
+        :return: command id.
+        '''
+
+        done = None
+        if callback is not None:
+            def done(cmd):
+                callback(cmd.status == 'COMPLETE' and not cmd.failed())
+
+        return self._set(object, value, callback=done, timeout=timeout).id
 
-        cmid = None
+    def _set(self, object, value, binary=False, callback=None, timeout=None):
+
+        cmd = None
+
+        self._cache.pop(object, None)
 
         if not binary:
             obj = object + '=' + str(value)
-            cmid = self.sendcomm('SET', obj)
+            cmd = self._sendcomm('SET', obj, callback, timeout)
         else:
             obj = object + ':', len(value)
-            cmid = self.sendcomm('SET', obj)
-            self.sock.write(value.tostring())
-        if wait:
-            start = time.time()
-            while not self.commands_sent[cmid].status == "COMPLETE":
-                if  time.time() > start+self['timeout']:
-                    self.log.warning('Command %i timed out...'%(cmid))
-                    break
-                continue
+            cmd = self._sendcomm('SET', obj, callback, timeout)
+            cmd._conn.write(value.tostring())
 
-        return cmid
+        return cmd
 
 
-    def getobject(self, object):
+    def getobject(self, object, timeout=None):
+
+        value = self._cached(object)
+        if value is not None:
+            return value
 
         # ocmid = self.get(object + '!TYPE', wait=True)
         #
@@ -395,20 +1189,7 @@ class TPL(ChimeraObject):
         #     log.warning( 'TPL2 getobject: got status %s ...' %st)
         #     return None
 
-        ocmid = self.get(object + '!TYPE;' + object, wait=True)
-
-        start = time.time()
-        while not self.commands_sent[ocmid].complete:
-            time.sleep(self["waittime"])
-            if time.time() > start+self["timeout"]:
-                break
-
-        if len(self.commands_sent[ocmid].data) > 0:
-            return self.commands_sent[ocmid].data[0]
-        else:
-            cmd = '%s'%self.commands_sent[ocmid]
-            self.log.warning('Command %s returned nothing...'%(cmd[:-2]))
-            return None
+        return self.getresult(self.get_async(object, timeout=timeout))
 
         st = self.commands_sent[ocmid].status
 
@@ -438,5 +1219,259 @@ class TPL(ChimeraObject):
             self.received_objects[object] = None
         return self.received_objects[object]
 
+    def get_async(self, object, callback=None, timeout=None):
+        '''
+        Request an object without waiting for the answer. Requests are
+        tagged with their command id, so any number of them may be in flight
+        at once; collect them with getresult or getresults.
+
+        :param object: object name.
+        :param callback: if given, callback(value) is called as soon as the
+                         answer arrives (value is None if nothing was
+                         returned). It runs on the reader thread and must not
+                         block. Callbacks can not be passed through a Pyro
+                         proxy.
+        :param timeout: deadline (in seconds) of the request, defaults to
+                        'get_timeout'.
+        :return: command id, the handle to pass to getresult.
+        '''
+
+        done = None
+        if callback is not None:
+            def done(cmd):
+                callback(cmd.data[0] if len(cmd.data) > 0 else None)
+
+        return self._sendcomm('GET', self._request(object), done, timeout).id
+
+    def getresult(self, cmdid, timeout=None):
+        '''
+        Wait for a request made with get_async and return the object value.
+
+        :param cmdid: command id returned by get_async.
+        :param timeout: maximum time to wait (in seconds), the request
+                        deadline if not given or shorter.
+        :return: the object value, None if nothing was returned in time.
+        '''
+
+        cmd = self.getCmd(cmdid)
+        if cmd is None:
+            return None
+
+        self._wait(cmd, timeout)
+
+        if len(cmd.data) > 0:
+            return cmd.data[0]
+        else:
+            self.log.warning('Command %s returned nothing...'%(str(cmd)[:-2]))
+            return None
+
+    def getresults(self, cmdids, timeout=None):
+        '''
+        Wait for a list of requests made with get_async.
+
+        :param cmdids: list of command ids returned by get_async.
+        :param timeout: maximum time to wait for all of them (in seconds),
+                        each request deadline if not given.
+        :return: list with the object values, in the same order as cmdids.
+        '''
+
+        if timeout is None:
+            return [self.getresult(cmdid) for cmdid in cmdids]
+
+        end = time.time() + timeout
+
+        return [self.getresult(cmdid, max(0., end - time.time())) for cmdid in cmdids]
+
+    def _request(self, object):
+        '''
+        Build a GET request for object, asking for its type only if it is not
+        known yet.
+        '''
+        if object in self._types:
+            return object
+        return object + '!TYPE;' + object
+
+    def getobjects(self, objects, timeout=None):
+        '''
+        Get a list of objects with a single TPL command.
+
+        :param objects: list of object names.
+        :param timeout: deadline (in seconds), defaults to 'get_timeout'.
+        :return: dictionary with object names as keys. Objects that returned
+                 nothing are set to None.
+        '''
+
+        ret = {}
+        missing = []
+        for obj in objects:
+            ret[obj] = self._cached(obj)
+            if ret[obj] is None:
+                missing.append(obj)
+
+        if len(missing) == 0:
+            return ret
+
+        request = ';'.join([self._request(obj) for obj in missing])
+        cmd = self._get(request, wait=True, timeout=timeout)
+
+        for obj in missing:
+            ret[obj] = cmd.values.get(obj)
+            if ret[obj] is None:
+                self.log.warning('Command %i returned nothing for %s...' % (cmd.id, obj))
+
+        return ret
+
+    def _ttl(self, object):
+        '''
+        Time to live (s) of object in the cache, 0 if it is not cached.
+        '''
+        ttl = self._ttls.get(object)
+        if ttl is None:
+            ttl = 0.
+            for pattern, pttl in self._cachettl:
+                if fnmatch.fnmatchcase(object, pattern):
+                    ttl = pttl
+                    break
+            self._ttls[object] = ttl
+        return ttl
+
+    def _cached(self, object):
+        '''
+        Cached value of object, None if it is not cached or too old.
+        '''
+        entry = self._cache.get(object)
+        if entry is not None and time.time() - entry[1] < self._ttl(object):
+            return entry[0]
+        return None
+
+    def invalidate(self, objects=None):
+        '''
+        Drop objects (all if None) from the cache.
+        '''
+        if objects is None:
+            self._cache.clear()
+        else:
+            for obj in objects:
+                self._cache.pop(obj, None)
+
+    def _subscriberloop(self):
+        '''
+        Keep subscribed objects fresh, reading all of them with a single
+        command at 'subscribe_freq'. Values are stored by dispatch. Also
+        expires commands past their deadline.
+        '''
+
+        while not self._subscriber_stop.isSet():
+            self._sweep()
+            objects = self._subscribed.keys()
+            if objects and (self._subcmd is None or self._subcmd.complete):
+                try:
+                    self._subcmd = self._sendcomm('GET', ';'.join([self._request(obj) for obj in objects]))
+                except Exception, e:
+                    self.log.error('[subscriber] Could not refresh subscribed objects.')
+                    self.log.exception(e)
+            self._subscriber_stop.wait(1. / self['subscribe_freq'])
+
+    def _updatesubscribed(self, object, value):
+        callbacks = []
+        self._subcond.acquire()
+        try:
+            if object in self._subscribed and self._subscribed[object] != value:
+                self._subscribed[object] = value
+                self._subcond.notifyAll()
+                callbacks = self._subcallbacks.get(object, [])[:]
+        finally:
+            self._subcond.release()
+
+        for callback in callbacks:
+            self._callback(callback, object, value)
+
+    def subscribe(self, objects, callback=None):
+        '''
+        Keep a local, always fresh copy of a list of objects. Subscriptions
+        are counted, each call must be matched by a call to unsubscribe.
+        Subscribed objects are read at 'subscribe_freq' for as long as they
+        are subscribed, so only hold them while waiting on them.
+
+        :param objects: list of object names.
+        :param callback: if given, callback(object, value) is called every
+                         time one of the objects changes. It runs on the
+                         reader thread and must not block. Callbacks can not
+                         be passed through a Pyro proxy.
+        :return: dictionary with the current values of the objects.
+        '''
+
+        values = self.getobjects(objects)
+
+        self._subcond.acquire()
+        try:
+            for obj in objects:
+                self._subcount[obj] += 1
+                if obj not in self._subscribed:
+                    self._subscribed[obj] = values[obj]
+                if callback is not None:
+                    self._subcallbacks[obj].append(callback)
+        finally:
+            self._subcond.release()
+
+        return values
+
+    def unsubscribe(self, objects, callback=None):
+
+        self._subcond.acquire()
+        try:
+            for obj in objects:
+                if callback is not None and callback in self._subcallbacks.get(obj, []):
+                    self._subcallbacks[obj].remove(callback)
+                if self._subcount.get(obj, 0) > 1:
+                    self._subcount[obj] -= 1
+                else:
+                    self._subcount.pop(obj, None)
+                    self._subscribed.pop(obj, None)
+                    self._subcallbacks.pop(obj, None)
+            # wake up anyone waiting on objects no longer subscribed
+            self._subcond.notifyAll()
+        finally:
+            self._subcond.release()
+
+    def getsubscribed(self, object):
+        '''
+        Get the local copy of a subscribed object. Falls back to reading it
+        from the server if the object is not subscribed.
+        '''
+        if object in self._subscribed:
+            return self._subscribed[object]
+        return self.getobject(object)
+
+    def waitchange(self, object, value, timeout=None):
+        '''
+        Wait until a subscribed object is different from value.
+
+        :param object: object name.
+        :param value: last known value of the object.
+        :param timeout: maximum time to wait (in seconds), None waits forever.
+        :return: the current value of the object, which is still value if
+                 timeout expired.
+        '''
+        if object not in self._subscribed:
+            return self.getobject(object)
+
+        end = None if timeout is None else time.time() + timeout
+
+        self._subcond.acquire()
+        try:
+            while object in self._subscribed and self._subscribed[object] == value:
+                if end is None:
+                    self._subcond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self._subcond.wait(remaining)
+            return self._subscribed.get(object, value)
+        finally:
+            self._subcond.release()
+
     def succeeded(self,cmdid):
-         return self.commands_sent[cmdid].status == 'COMPLETE'
\ No newline at end of file
+         cmd = self.getCmd(cmdid)
+         return cmd is not None and cmd.status == 'COMPLETE'
\ No newline at end of file
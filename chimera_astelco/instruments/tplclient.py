@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+# chimera - observatory automation system
+# Copyright (C) 2006-2007  P. Henrique Silva <henrique@astro.ufsc.br>
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import threading
+
+from chimera.core.exceptions import ObjectNotFoundException
+
+__all__ = ["TPLClient"]
+
+
+class TPLClient(object):
+    '''
+    Access to the TPL instance named by the 'tpl' option, shared by the
+    Astelco instruments. Call _resetTPL from __init__.
+    '''
+
+    def _resetTPL(self):
+        # Pyro proxies can not be shared between threads, so keep one per
+        # thread.
+        self._tpl = threading.local()
+
+    def getTPL(self):
+        # Proxies are checked by _checkTPL from control().
+        tpl = getattr(self._tpl, 'proxy', None)
+        if tpl is None:
+            try:
+                tpl = self.getManager().getProxy(self['tpl'], lazy=True)
+            except ObjectNotFoundException:
+                return False
+            self._tpl.proxy = tpl
+        return tpl
+
+    def _checkTPL(self):
+        '''
+        Check that the TPL is still reachable. If not, drop the cached proxies
+        so they are resolved again on next use.
+
+        :return: True if TPL answered, False otherwise.
+        '''
+        try:
+            tpl = self.getTPL()
+            if tpl is not False and tpl.ping():
+                return True
+        except Exception, e:
+            self.log.warning('TPL %s not reachable: %s' % (self['tpl'], e))
+        self._resetTPL()
+        return False
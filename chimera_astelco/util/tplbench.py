@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+# chimera - observatory automation system
+# Copyright (C) 2006-2007  P. Henrique Silva <henrique@astro.ufsc.br>
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+'''
+Latency and throughput benchmark of the TPL client.
+
+Each run starts a TPL instance with the given configuration, connects it to
+a TPL2 server (usually the simulator, see tplsim) and measures:
+
+ - getobject: latency of a single object read;
+ - set: latency of a set waiting for completion;
+ - batch: latency of reading N objects with a single command;
+ - pipeline: latency of reading N objects with N commands in flight at once;
+ - throughput: commands per second completed by a few threads reading
+   objects as fast as they can;
+ - cpu: CPU time (user + system) of this process per command.
+
+The simulator runs in a separate process, so the CPU time is the client's
+alone.
+'''
+
+import os
+import time
+import threading
+import itertools
+import multiprocessing
+
+from chimera_astelco.util.tplsim import TPLSimulator
+from chimera_astelco.util.tpltrace import percentile
+
+__all__ = ["TPLBench", "percentile", "startSimulator", "sweep", "report"]
+
+
+def _runSimulator(conn, kwargs):
+    sim = TPLSimulator(**kwargs)
+    conn.send(sim.address)
+    sim.serve_forever()
+
+
+def startSimulator(**kwargs):
+    '''
+    Start a TPLSimulator in a child process.
+
+    :return: (process, (host, port))
+    '''
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_runSimulator, args=(child, kwargs))
+    proc.daemon = True
+    proc.start()
+    return proc, parent.recv()
+
+
+class TPLBench(object):
+
+    GetObject = 'POSITION.LOCAL.SIDEREAL_TIME'
+    SetObject = 'POINTING.SETUP.DOME.SYNCMODE'
+    BatchObjects = ['POSITION.EQUATORIAL.RA_J2000',
+                    'POSITION.EQUATORIAL.DEC_J2000',
+                    'POSITION.HORIZONTAL.ALT',
+                    'POSITION.HORIZONTAL.AZ',
+                    'POSITION.LOCAL.SIDEREAL_TIME',
+                    'POSITION.INSTRUMENTAL.HA.OFFSET',
+                    'POSITION.INSTRUMENTAL.DEC.OFFSET',
+                    'TELESCOPE.MOTION_STATE',
+                    'TELESCOPE.READY_STATE',
+                    'POINTING.TRACK'] + \
+                   ['AUXILIARY.SENSOR[%i].VALUE' % i for i in range(1, 7)]
+
+    def __init__(self, host, port, user='admin', password='admin',
+                 n=200, batch=10, threads=4, duration=5.):
+
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.n = n
+        self.batch = batch
+        self.threads = threads
+        self.duration = duration
+
+    def _latency(self, func, n):
+        latency = []
+        for i in range(n):
+            t0 = time.time()
+            func()
+            latency.append(time.time() - t0)
+        return latency
+
+    def _throughput(self, tpl):
+
+        count = [0] * self.threads
+        deadline = time.time() + self.duration
+
+        def worker(i):
+            while time.time() < deadline:
+                tpl.getobject(self.GetObject)
+                count[i] += 1
+
+        workers = [threading.Thread(target=worker, args=(i,))
+                   for i in range(self.threads)]
+        t0 = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        return sum(count), time.time() - t0
+
+    def run(self, **config):
+        '''
+        Run the benchmark with TPL configured with config.
+
+        :return: dict with the latency percentiles (s) of getobject, set,
+                 batch and pipeline, commands per second and CPU time (s)
+                 per command.
+        '''
+
+        from chimera_astelco.instruments.tpl import TPL
+
+        tpl = TPL()
+        tpl['tpl_host'] = self.host
+        tpl['tpl_port'] = self.port
+        tpl['user'] = self.user
+        tpl['password'] = self.password
+        for key, value in config.items():
+            tpl[key] = value
+
+        tpl.__start__()
+        loop = threading.Thread(target=tpl.__main__, name='tplbench-control')
+        loop.setDaemon(True)
+        loop.start()
+
+        batch = (self.BatchObjects * (self.batch / len(self.BatchObjects) + 1))[:self.batch]
+
+        results = dict(config=config)
+
+        try:
+            # warm up, also fills the type cache
+            for i in range(10):
+                tpl.getobject(self.GetObject)
+            tpl.getobjects(batch)
+
+            cpu0 = os.times()
+
+            latency = self._latency(lambda: tpl.getobject(self.GetObject), self.n)
+            results['getobject'] = [percentile(latency, p) for p in (50, 95, 99)]
+
+            latency = self._latency(lambda: tpl.set(self.SetObject, 0, wait=True), self.n)
+            results['set'] = [percentile(latency, p) for p in (50, 95, 99)]
+
+            latency = self._latency(lambda: tpl.getobjects(batch), self.n)
+            results['batch'] = [percentile(latency, p) for p in (50, 95, 99)]
+
+            latency = self._latency(lambda: tpl.getresults([tpl.get_async(obj) for obj in batch]), self.n)
+            results['pipeline'] = [percentile(latency, p) for p in (50, 95, 99)]
+
+            ncmd, elapsed = self._throughput(tpl)
+            results['throughput'] = ncmd / elapsed
+
+            cpu1 = os.times()
+            ncmd += (3 + len(batch)) * self.n
+            results['cpu'] = ((cpu1[0] - cpu0[0]) + (cpu1[1] - cpu0[1])) / ncmd
+        finally:
+            tpl.__abort_loop__()
+            tpl.__stop__()
+
+        return results
+
+
+def sweep(bench, **values):
+    '''
+    Run bench for every combination of the given TPL configuration values,
+    e.g. sweep(bench, freq=[1, 2], waittime=[0.01, 0.1]).
+
+    :return: list of results, see TPLBench.run.
+    '''
+
+    keys = sorted(values.keys())
+    results = []
+    for combination in itertools.product(*[values[key] for key in keys]):
+        results.append(bench.run(**dict(zip(keys, combination))))
+    return results
+
+
+def report(results):
+    '''
+    Format results of TPLBench.run (or sweep) as a table, latencies in ms.
+    '''
+
+    if isinstance(results, dict):
+        results = [results]
+
+    keys = sorted(set(itertools.chain(*[r['config'].keys() for r in results])))
+
+    header = ' '.join(['%10s' % key for key in keys])
+    header += ' | %-20s | %-20s | %-20s | %-20s | %8s %8s' % ('getobject p50/95/99', 'set p50/95/99',
+                                                             'batch p50/95/99', 'pipeline p50/95/99',
+                                                             'cmd/s', 'cpu/cmd')
+    lines = [header, '-' * len(header)]
+
+    for r in results:
+        line = ' '.join(['%10s' % r['config'].get(key, '') for key in keys])
+        for test in ('getobject', 'set', 'batch', 'pipeline'):
+            line += ' | %6.2f %6.2f %6.2f' % tuple([v * 1e3 for v in r[test]])
+        line += ' | %8.1f %8.3f' % (r['throughput'], r['cpu'] * 1e3)
+        lines.append(line)
+
+    return '\n'.join(lines)
@@ -0,0 +1,608 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+# chimera - observatory automation system
+# Copyright (C) 2006-2007  P. Henrique Silva <henrique@astro.ufsc.br>
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+'''
+A stand-in for an AsTelOS TPL2 server, to exercise the TPL, AstelcoTelescope,
+AstelcoDome and AstelcoFocuser drivers without hardware.
+
+It speaks enough of the protocol for the drivers: the TPL2/AUTH handshake,
+GET (with ';' separated lists and !TYPE), SET, ABORT and DISCONNECT. Long
+running SETs (slews, READY, focus, dome, cover and pointing model) complete
+after a configurable time. Replies can be delayed (latency and jitter) and
+cut in random fragments to reproduce slow or congested links.
+
+Example::
+
+    sim = TPLSimulator(port=65432, latency=0.02, jitter=0.005, fragment=16)
+    sim.start()
+    ...
+    sim.stop()
+'''
+
+import time
+import math
+import random
+import socket
+import threading
+import SocketServer
+
+__all__ = ["TPLSimulator"]
+
+# Type codes, as returned for OBJECT!TYPE
+_TypeCode = {int: '1', float: '2', str: '3'}
+
+
+def _lst():
+    # Good enough for a simulator, it only has to move like a sidereal clock
+    return (time.time() / 3600. * 1.00273790935 + 6.) % 24.
+
+
+def defaultObjects():
+    '''
+    Object tree of a simulated telescope with hexapod, dome, cover and
+    sensors. Values may be callables, they are evaluated on every read.
+    '''
+
+    start = time.time()
+
+    objects = {'SERVER.UPTIME': lambda: int(time.time() - start),
+               'SERVER.INFO.DEVICE': 'TPL2 simulator',
+
+               'TELESCOPE.CONFIG.MOUNTOPTIONS': 'AZ-ZD',
+               'TELESCOPE.READY': 0,
+               'TELESCOPE.READY_STATE': 1.0,
+               'TELESCOPE.MOTION_STATE': 0,
+               'TELESCOPE.STOP': 0,
+               'TELESCOPE.STATUS.GLOBAL': 0,
+               'TELESCOPE.STATUS.LIST': '',
+               'TELESCOPE.STATUS.CLEAR': 0,
+
+               'POSITION.EQUATORIAL.RA_J2000': 6.,
+               'POSITION.EQUATORIAL.DEC_J2000': -30.,
+               'POSITION.EQUATORIAL.PARALLACTIC_ANGLE': 0.,
+               'POSITION.HORIZONTAL.ALT': 60.,
+               'POSITION.HORIZONTAL.AZ': 180.,
+               'POSITION.HORIZONTAL.DOME': 180.,
+               'POSITION.LOCAL.SIDEREAL_TIME': _lst,
+               'POSITION.LOCAL.UTC': lambda: time.time(),
+               'POSITION.INSTRUMENTAL.HA.OFFSET': 0.,
+               'POSITION.INSTRUMENTAL.DEC.OFFSET': 0.,
+               'POSITION.INSTRUMENTAL.HA.MOTION_STATE': 0,
+               'POSITION.INSTRUMENTAL.DEC.MOTION_STATE': 0,
+               'POSITION.INSTRUMENTAL.DOME[0].CURRPOS': 180.,
+               'POSITION.INSTRUMENTAL.DOME[0].TARGETPOS': 180.,
+               'POSITION.INSTRUMENTAL.DOME[0].OFFSET': 0.,
+
+               'OBJECT.EQUATORIAL.RA': 6.,
+               'OBJECT.EQUATORIAL.DEC': -30.,
+               'OBJECT.EQUATORIAL.EPOCH': 2000.,
+               'OBJECT.HORIZONTAL.ALT': 60.,
+               'OBJECT.HORIZONTAL.AZ': 180.,
+
+               'POINTING.TRACK': 0,
+               'POINTING.SLEWTIME': 0.,
+               'POINTING.SETUP.ORIENTATION': 2,
+               'POINTING.SETUP.OPTIMIZATION': 2,
+               'POINTING.SETUP.LOCAL.LATITUDE': -30.,
+               'POINTING.SETUP.LOCAL.LONGITUDE': -70.,
+               'POINTING.SETUP.DOME.SYNCMODE': 0,
+               'POINTING.MODEL.FILE': 'default.dat',
+               'POINTING.MODEL.FILE_LIST': 'default.dat,extended.dat',
+               'POINTING.MODEL.TYPE': 1,
+               'POINTING.MODEL.CALCULATE': 0.,
+               'POINTING.MODEL.LIST': '',
+               'POINTING.MODEL.ADD': '',
+               'POINTING.MODEL.CLEAR': 0,
+               'POINTING.MODEL.LOAD': 0,
+
+               'AUXILIARY.PADDLE.BRIGHTNESS': 0.,
+               'AUXILIARY.COVER.REALPOS': 0.,
+               'AUXILIARY.COVER.TARGETPOS': 0.,
+               'AUXILIARY.DOME.REALPOS': 0.,
+               'AUXILIARY.DOME.TARGETPOS': 0.,
+               }
+
+    sensors = [('Temperature M1', 'C', 12.),
+               ('Temperature M2', 'C', 11.5),
+               ('Temperature Tube', 'C', 11.),
+               ('Temperature Ambient', 'C', 10.),
+               ('Humidity', '%', 60.),
+               ('Pressure', 'hPa', 780.)]
+
+    for n, (description, unit, base) in enumerate(sensors):
+        objects['AUXILIARY.SENSOR[%i].DESCRIPTION' % (n + 1)] = description
+        objects['AUXILIARY.SENSOR[%i].UNITY' % (n + 1)] = unit
+        # slow drift, with a different phase for each sensor
+        objects['AUXILIARY.SENSOR[%i].VALUE' % (n + 1)] = \
+            lambda base=base, n=n: base + math.sin(time.time() / 600. + n)
+
+    # a broken sensor, drivers should skip it
+    n = len(sensors) + 1
+    objects['AUXILIARY.SENSOR[%i].DESCRIPTION' % n] = 'FAILED'
+    objects['AUXILIARY.SENSOR[%i].UNITY' % n] = ''
+    objects['AUXILIARY.SENSOR[%i].VALUE' % n] = 0.
+
+    for ax in range(6):
+        focus = 'POSITION.INSTRUMENTAL.FOCUS[%i].' % ax
+        objects[focus + 'REALPOS'] = 0.
+        objects[focus + 'REALPOS!MIN'] = -10.
+        objects[focus + 'REALPOS!MAX'] = 10.
+        objects[focus + 'OFFSET'] = 0.
+        objects[focus + 'MOTION_STATE'] = 0
+        objects[focus + 'LIMIT_STATE'] = 0
+
+    return objects
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sim = self.server.sim
+        self.wlock = threading.Lock()
+        self.closed = False
+
+    def write(self, lines):
+        '''
+        Write a block of lines. The block may be sent in random fragments, but
+        blocks are never interleaved.
+        '''
+
+        data = ''.join(['%s\n' % line for line in lines])
+
+        self.wlock.acquire()
+        try:
+            if self.closed:
+                return
+            fragment = self.sim.fragment
+            if fragment > 0:
+                while data:
+                    size = random.randint(1, fragment)
+                    self.wfile.write(data[:size])
+                    self.wfile.flush()
+                    data = data[size:]
+                    if data and self.sim.fragment_delay > 0:
+                        time.sleep(self.sim.fragment_delay)
+            else:
+                self.wfile.write(data)
+                self.wfile.flush()
+        except (socket.error, AttributeError, ValueError):
+            # the connection went away under us
+            self.closed = True
+        finally:
+            self.wlock.release()
+
+        self.sim.stats['lines'] += len(lines)
+
+    def handle(self):
+
+        conn = self.sim._connect(self)
+
+        try:
+            self.write(['TPL2 2.0 CONN %i' % conn,
+                        'AUTH PLAIN',
+                        'ENC MESSAGE %s' % ('%08x' % random.getrandbits(32))])
+
+            line = self.rfile.readline()
+            fields = line.replace('"', ' ').split()
+            if len(fields) == 4 and fields[:2] == ['AUTH', 'PLAIN'] and \
+                    fields[2:] == [self.sim.user, self.sim.password]:
+                self.write(['AUTH OK 4 4'])
+            else:
+                self.write(['AUTH FAILED 0 0'])
+                return
+
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                if line == 'DISCONNECT':
+                    break
+                self.sim._received(self, line)
+        except socket.error:
+            pass
+        finally:
+            self._close()
+            self.sim._disconnect(self)
+
+    def _close(self):
+        # delayed replies may still be on their way, make sure they see the
+        # connection closed before its files are torn down
+        self.wlock.acquire()
+        try:
+            self.closed = True
+        finally:
+            self.wlock.release()
+
+    def finish(self):
+        self.wlock.acquire()
+        try:
+            self.closed = True
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+        finally:
+            self.wlock.release()
+
+
+class TPLSimulator(object):
+    '''
+    TPL2 server stand-in.
+
+    :param host: address to listen on.
+    :param port: port to listen on, 0 picks a free one (see address).
+    :param latency: time (s) before a command is answered.
+    :param jitter: maximum random deviation (s) of latency.
+    :param fragment: if > 0, replies are cut in fragments of up to this
+                     number of bytes.
+    :param slewtime: duration (s) of a slew.
+    :param readytime: time (s) to power the telescope up or down.
+    :param movetime: duration (s) of focus, dome and cover movements.
+    :param calctime: time (s) to calculate a pointing model.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0., jitter=0.,
+                 fragment=0, slewtime=5., readytime=10., movetime=1.,
+                 calctime=2., user='admin', password='admin'):
+
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment = fragment
+        self.fragment_delay = 0.001
+        self.slewtime = slewtime
+        self.readytime = readytime
+        self.movetime = movetime
+        self.calctime = calctime
+        self.user = user
+        self.password = password
+
+        self.objects = defaultObjects()
+        self.stats = {'commands': 0, 'lines': 0, 'connections': 0}
+
+        self._lock = threading.RLock()
+        self._clients = []
+        # long running commands, (handler, cmdid) -> timer
+        self._running = {}
+
+        self.server = _Server((host, port), _Handler)
+        self.server.sim = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='tplsim')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.dropConnections()
+        self.server.server_close()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def dropConnections(self):
+        '''
+        Close every client connection, as a network failure would.
+        '''
+        self._lock.acquire()
+        try:
+            clients = self._clients[:]
+        finally:
+            self._lock.release()
+
+        for client in clients:
+            client._close()
+            try:
+                client.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    # object tree
+
+    def getobject(self, name):
+        self._lock.acquire()
+        try:
+            value = self.objects[name]
+        finally:
+            self._lock.release()
+        if callable(value):
+            value = value()
+        return value
+
+    def setobject(self, name, value):
+        self._lock.acquire()
+        try:
+            self.objects[name] = value
+        finally:
+            self._lock.release()
+
+    def _typecode(self, name):
+        return _TypeCode.get(type(self.getobject(name)), '0')
+
+    def _format(self, value):
+        if isinstance(value, str):
+            return '"%s"' % value
+        return repr(value)
+
+    def _convert(self, name, value):
+        value = value.strip()
+        vtype = type(self.getobject(name))
+        if vtype is str:
+            return value.strip('"')
+        elif vtype is int:
+            return int(float(value))
+        return vtype(value)
+
+    # connections
+
+    def _connect(self, client):
+        self._lock.acquire()
+        try:
+            self._clients.append(client)
+            self.stats['connections'] += 1
+            return self.stats['connections']
+        finally:
+            self._lock.release()
+
+    def _disconnect(self, client):
+        self._lock.acquire()
+        try:
+            if client in self._clients:
+                self._clients.remove(client)
+            for key in [key for key in self._running if key[0] is client]:
+                self._running.pop(key).cancel()
+        finally:
+            self._lock.release()
+
+    def _received(self, client, line):
+
+        self.stats['commands'] += 1
+
+        fields = line.split(None, 2)
+        if len(fields) < 2 or not fields[0].isdigit():
+            return
+
+        cmdid, cmd = int(fields[0]), fields[1].upper()
+        args = fields[2] if len(fields) > 2 else ''
+
+        delay = self.latency
+        if self.jitter > 0:
+            delay = max(0., delay + random.uniform(-self.jitter, self.jitter))
+
+        if delay > 0:
+            timer = threading.Timer(delay, self._execute, (client, cmdid, cmd, args))
+            timer.setDaemon(True)
+            timer.start()
+        else:
+            self._execute(client, cmdid, cmd, args)
+
+    def _execute(self, client, cmdid, cmd, args):
+
+        if cmd == 'GET':
+            self._get(client, cmdid, args)
+        elif cmd == 'SET':
+            self._set(client, cmdid, args)
+        elif cmd == 'ABORT':
+            self._abort(client, cmdid, args)
+        else:
+            client.write(['%i COMMAND ERROR UNKNOWN COMMAND %s' % (cmdid, cmd)])
+
+    def _get(self, client, cmdid, args):
+
+        lines = ['%i COMMAND OK' % cmdid]
+
+        for name in args.split(';'):
+            name = name.strip()
+            try:
+                if name.endswith('!TYPE'):
+                    value = self._typecode(name[:-5])
+                else:
+                    value = self._format(self.getobject(name))
+                lines.append('%i DATA INLINE %s=%s' % (cmdid, name, value))
+            except KeyError:
+                lines.append('%i EVENT ERROR %s:UNKNOWN OBJECT' % (cmdid, name))
+
+        lines.append('%i COMMAND COMPLETE' % cmdid)
+
+        client.write(lines)
+
+    def _set(self, client, cmdid, args):
+
+        name, sep, value = args.partition('=')
+        name = name.strip()
+
+        try:
+            value = self._convert(name, value)
+        except KeyError:
+            client.write(['%i COMMAND OK' % cmdid,
+                          '%i EVENT ERROR %s:UNKNOWN OBJECT' % (cmdid, name),
+                          '%i COMMAND COMPLETE' % cmdid])
+            return
+        except ValueError:
+            client.write(['%i COMMAND OK' % cmdid,
+                          '%i EVENT ERROR %s:INVALID VALUE' % (cmdid, name),
+                          '%i COMMAND COMPLETE' % cmdid])
+            return
+
+        self.setobject(name, value)
+
+        client.write(['%i COMMAND OK' % cmdid,
+                      '%i DATA OK %s' % (cmdid, name)])
+
+        duration, done = self._action(name, value)
+
+        if duration > 0:
+            def complete():
+                self._lock.acquire()
+                try:
+                    if self._running.pop((client, cmdid), None) is None:
+                        return  # aborted
+                finally:
+                    self._lock.release()
+                if done is not None:
+                    done()
+                client.write(['%i COMMAND COMPLETE' % cmdid])
+
+            timer = threading.Timer(duration, complete)
+            timer.setDaemon(True)
+            self._lock.acquire()
+            try:
+                self._running[(client, cmdid)] = timer
+            finally:
+                self._lock.release()
+            timer.start()
+        else:
+            if done is not None:
+                done()
+            client.write(['%i COMMAND COMPLETE' % cmdid])
+
+    def _abort(self, client, cmdid, args):
+
+        try:
+            target = int(args.strip())
+        except ValueError:
+            client.write(['%i COMMAND ERROR INVALID ID' % cmdid])
+            return
+
+        self._lock.acquire()
+        try:
+            timer = self._running.pop((client, target), None)
+        finally:
+            self._lock.release()
+
+        lines = ['%i COMMAND OK' % cmdid]
+        if timer is not None:
+            timer.cancel()
+            self._stopmotion()
+            lines.append('%i EVENT ERROR ABORT:COMMAND ABORTED' % target)
+            lines.append('%i COMMAND COMPLETE' % target)
+        lines.append('%i COMMAND COMPLETE' % cmdid)
+
+        client.write(lines)
+
+    # telescope behaviour
+
+    def _stopmotion(self):
+        for name in ('TELESCOPE.MOTION_STATE',
+                     'POSITION.INSTRUMENTAL.HA.MOTION_STATE',
+                     'POSITION.INSTRUMENTAL.DEC.MOTION_STATE'):
+            self.setobject(name, 0)
+
+    def _ramp(self, name, target, duration):
+        '''
+        Make object go linearly from its current value to target.
+        '''
+        start, t0 = self.getobject(name), time.time()
+
+        def value():
+            frac = min((time.time() - t0) / duration, 1.) if duration > 0 else 1.
+            return start + (target - start) * frac
+
+        self.setobject(name, value)
+
+    def _action(self, name, value):
+        '''
+        Side effects of setting an object.
+
+        :return: (duration, done), the command completes after duration
+                 seconds, calling done (if not None) first.
+        '''
+
+        if name == 'POINTING.TRACK' and value == 2:
+            for obj in ('TELESCOPE.MOTION_STATE',
+                        'POSITION.INSTRUMENTAL.HA.MOTION_STATE',
+                        'POSITION.INSTRUMENTAL.DEC.MOTION_STATE'):
+                self.setobject(obj, 1)
+
+            def done():
+                self.setobject('POSITION.EQUATORIAL.RA_J2000',
+                               self.getobject('OBJECT.EQUATORIAL.RA'))
+                self.setobject('POSITION.EQUATORIAL.DEC_J2000',
+                               self.getobject('OBJECT.EQUATORIAL.DEC'))
+                self._stopmotion()
+            return self.slewtime, done
+
+        elif name == 'POINTING.TRACK':
+            self._stopmotion()
+            return 0, None
+
+        elif name in ('OBJECT.EQUATORIAL.RA', 'OBJECT.EQUATORIAL.DEC',
+                      'OBJECT.HORIZONTAL.ALT', 'OBJECT.HORIZONTAL.AZ'):
+            self.setobject('POINTING.SLEWTIME', float(self.slewtime))
+            return 0, None
+
+        elif name == 'TELESCOPE.STOP':
+            self._stopmotion()
+            return 0, None
+
+        elif name == 'TELESCOPE.READY':
+            target = 1. if value else 0.
+            self._ramp('TELESCOPE.READY_STATE', target, self.readytime)
+
+            def done():
+                self.setobject('TELESCOPE.READY_STATE', target)
+            return self.readytime, done
+
+        elif name == 'TELESCOPE.STATUS.CLEAR':
+            self.setobject('TELESCOPE.STATUS.GLOBAL', 0)
+            return 0, None
+
+        elif name == 'POINTING.MODEL.CALCULATE':
+            return self.calctime, None
+
+        elif name.startswith('POSITION.INSTRUMENTAL.FOCUS[') and name.endswith('].OFFSET'):
+            focus = name[:-len('OFFSET')]
+            self.setobject(focus + 'MOTION_STATE', 1)
+            self._ramp(focus + 'REALPOS', value, self.movetime)
+
+            def done():
+                self.setobject(focus + 'REALPOS', value)
+                self.setobject(focus + 'MOTION_STATE', 0)
+            return self.movetime, done
+
+        elif name == 'POSITION.INSTRUMENTAL.DOME[0].TARGETPOS':
+            self._ramp('POSITION.INSTRUMENTAL.DOME[0].CURRPOS', value, self.movetime)
+            return 0, None
+
+        elif name in ('AUXILIARY.DOME.TARGETPOS', 'AUXILIARY.COVER.TARGETPOS'):
+            realpos = name.replace('TARGETPOS', 'REALPOS')
+            self._ramp(realpos, float(value), self.movetime)
+
+            def done():
+                self.setobject(realpos, float(value))
+            return self.movetime, done
+
+        return 0, None
@@ -0,0 +1,236 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+# chimera - observatory automation system
+# Copyright (C) 2006-2007  P. Henrique Silva <henrique@astro.ufsc.br>
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+'''
+TPL wire trace recording and replay.
+
+A trace is a NDJSON file, one exchange per line::
+
+    {"t": 0.0, "dir": "start", "time": 1476662400.0}
+    {"t": 1.520311, "dir": "tx", "conn": "tpl-reader-0", "line": "12 GET POINTING.TRACK"}
+    {"t": 1.532874, "dir": "rx", "conn": "tpl-reader-0", "line": "12 COMMAND OK"}
+
+t is the time (s) since the start of the recording, from a monotonic clock,
+and the start record holds the wall clock time it refers to. TPL records a
+trace when 'trace_file' is set; replay sends the commands of a trace again,
+with the same timing or faster, to measure how TPL copes with real traffic.
+'''
+
+import os
+import sys
+import time
+import json
+import Queue
+import ctypes
+import threading
+
+__all__ = ["TraceRecorder", "readtrace", "replay", "report", "monotonic", "percentile"]
+
+
+def percentile(values, p):
+    '''
+    p-th percentile of values, with linear interpolation.
+    '''
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def _clock():
+
+    if not sys.platform.startswith('linux'):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        librt = ctypes.CDLL('librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    CLOCK_MONOTONIC = 1
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+# Monotonic clock (s), falls back to time.time where there is none
+monotonic = _clock()
+
+
+class TraceRecorder(object):
+    '''
+    Record the TPL wire trace to a NDJSON file. Records are written by a
+    background thread; if it falls behind by more than 'capacity' records,
+    new ones are dropped and counted.
+    '''
+
+    def __init__(self, path, batch=256, capacity=100000):
+
+        self.path = path
+        self.batch = batch
+        self.dropped = 0
+
+        self._file = open(path, 'a')
+        self._t0 = monotonic()
+        self._queue = Queue.Queue(capacity)
+
+        self._writer = threading.Thread(target=self._writerloop, name='tpl-trace')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+        self._queue.put((0., 'start', None, time.time()))
+
+    def record(self, direction, conn, line):
+        '''
+        :param direction: 'tx' for lines sent, 'rx' for lines received.
+        :param conn: name of the connection.
+        :param line: line without the end of line.
+        '''
+        try:
+            self._queue.put_nowait((monotonic() - self._t0, direction, conn, line))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _writerloop(self):
+        while True:
+            records = [self._queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            lines = []
+            for record in records:
+                if record is None:
+                    self._file.write(''.join(lines))
+                    self._file.close()
+                    return
+                t, direction, conn, line = record
+                if isinstance(line, str):
+                    # binary payloads are not valid UTF-8, keep their bytes
+                    line = line.decode('latin-1')
+                if direction == 'start':
+                    lines.append(json.dumps({'t': t, 'dir': direction, 'time': line}) + '\n')
+                else:
+                    lines.append(json.dumps({'t': round(t, 6), 'dir': direction, 'conn': conn,
+                                             'line': line}) + '\n')
+            self._file.write(''.join(lines))
+            self._file.flush()
+
+    def close(self):
+        if self._writer.isAlive():
+            self._queue.put(None)
+            self._writer.join(5)
+
+
+def readtrace(path):
+    '''
+    Iterate over the records of a trace file.
+    '''
+    with open(path) as trace:
+        for line in trace:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def replay(tpl, path, speed=1.):
+    '''
+    Send the commands recorded in a trace through tpl (a started TPL
+    instance, usually connected to the simulator), keeping their original
+    timing divided by speed.
+
+    :return: dict with the number of commands replayed, the latency (s) of
+             each, how late (s) commands were sent compared to the trace,
+             the duration (s) and the CPU time (s) spent.
+    '''
+
+    latency = []
+    lag = []
+    ids = {}
+
+    cpu0 = os.times()
+    start = monotonic()
+
+    for record in readtrace(path):
+
+        if record['dir'] != 'tx':
+            continue
+
+        fields = record['line'].encode('latin-1').split(None, 2)
+        if len(fields) < 3 or not fields[0].isdigit():
+            continue
+
+        oldid, comm, args = fields
+        if comm == 'ABORT' and args.isdigit():
+            args = str(ids.get(int(args), args))
+
+        delay = record['t'] / speed - (monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            lag.append(-delay)
+
+        sent = monotonic()
+
+        def done(cmd, sent=sent):
+            latency.append(monotonic() - sent)
+
+        ids[int(oldid)] = tpl.sendcomm(comm, args, callback=done)
+
+    for cmdid in ids.values():
+        tpl.waitcmd(cmdid)
+
+    cpu1 = os.times()
+
+    return dict(commands=len(ids), latency=latency, lag=lag,
+                duration=monotonic() - start,
+                cpu=(cpu1[0] - cpu0[0]) + (cpu1[1] - cpu0[1]))
+
+
+def report(result):
+    '''
+    Format the result of replay, times in ms.
+    '''
+
+    latency = [percentile(result['latency'], p) * 1e3 for p in (50, 95, 99)]
+
+    lines = ['commands: %i in %.1f s (%.1f cmd/s)' % (result['commands'], result['duration'],
+                                                     result['commands'] / max(result['duration'], 1e-9)),
+             'latency p50/95/99: %.2f %.2f %.2f ms' % tuple(latency),
+             'sent late: %i commands, max %.2f ms' % (len(result['lag']),
+                                                      max(result['lag'] or [0.]) * 1e3),
+             'cpu: %.3f ms/command' % (result['cpu'] / max(result['commands'], 1) * 1e3)]
+
+    return '\n'.join(lines)